@@ -4,7 +4,7 @@ import numpy as np
 import os, sys, pickle, tempfile, resource
 from neuroanalysis.ui.plot_grid import PlotGrid
 from multipatch_analysis.experiment_list import cached_experiments()
-from multipatch_analysis.connection_detection import MultiPatchExperimentAnalyzer, EvokedResponseGroup, fit_psp
+from multipatch_analysis.connection_detection import MultiPatchExperimentAnalyzer, EvokedResponseGroup, EvokedResponseArray, fit_psp
 from synaptic_properties import find_connections
 
 
@@ -26,7 +26,7 @@ def get_pulse_responses(expts, pre_type, post_type, **kwds):
         
         
 def plot_pulse_average(expts, pre_type, post_type, avg_plot, ind_plot, **kwds):
-    all_avgs = EvokedResponseGroup()
+    all_avgs = EvokedResponseArray(keep_traces=False)
     ind_plot.setLabels(left=('%s-%s'%(pre_type, post_type), 'V'), bottom=('Time', 's'))
     avg_plot.setLabels(left=('%s-%s'%(pre_type, post_type), 'V'), bottom=('Time', 's'))
     responses = get_pulse_responses(expts, pre_type, post_type, **kwds)
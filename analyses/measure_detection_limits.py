@@ -6,7 +6,6 @@ Analysis of detection limits vs synaptic strength, kinetics, and background nois
 from __future__ import print_function, division
 from datetime import datetime
 import sys
-import multiprocessing
 import pyqtgraph as pg
 import numpy as np
 from scipy import stats
@@ -15,6 +14,7 @@ from neuroanalysis.data import Trace, TraceList
 import strength_analysis
 from strength_analysis import TableGroup
 from multipatch_analysis.database import database as db
+from multipatch_analysis.work_queue import WorkQueue
 
 
 class DetectionLimitTableGroup(TableGroup):
@@ -96,50 +96,98 @@ def measure_limit(pair, session, classifier):
     bg_recs = q.all()
 
     # measure background connection strength
-    bg_results = [strength_analysis.analyze_response_strength(rec, 'baseline') for rec in bg_recs]
-    bg_results = strength_analysis.str_analysis_result_table(bg_results, bg_recs)
+    bg_results = strength_analysis.analyze_response_strength_batch(bg_recs, 'baseline')
+    bg_results = strength_analysis.strength_result_table(bg_results, bg_recs)
 
     # for this example, we use background data to simulate foreground
     # (but this will be biased due to lack of crosstalk in background data)
     fg_recs = bg_recs
 
-    # now measure foreground simulated under different conditions
-    amps = 2e-6 * 2**np.arange(9)
-    amps[0] = 0
+    # now measure foreground simulated at increasing amplitudes until the classifier
+    # confidence crosses its threshold, then narrow down the crossing by bisection
     rtime = 2e-3
-    dt = 1 / db.default_sample_rate
-    results = np.empty(len(amps), dtype=[('results', object), ('prediction', float), ('confidence', float), ('traces', object), ('rise_time', float), ('amp', float)])
     print("  Simulating synaptic events..")
-    # pool = multiprocessing.Pool(4)
     limit_entry = DetectionLimit(pair=pair)
 
-    results = []
-    avg_conf = []
-    limit = None
-    for i,amp in enumerate(amps):
-        print("----- %d/%d  %0.3g      \r" % (i, len(amps), amp),)
-        result = strength_analysis.simulate_connection(fg_recs, bg_results, classifier, amp, rtime)
-        results.append({'amp': amp, 'rise_time': rtime, 'predictions': list(result['predictions']), 'confidence': list(result['confidence'])})
-        avg_conf.append(result['confidence'].mean())
-        print(results[-1])
-        # if we crossed threshold, interpolate to estimate the minimum amplitude
-        # and terminate the loop early
-        if limit is None and i > 0 and avg_conf[-1] > classifier.prob_threshold:
-            a1 = amps[i-1]
-            a2 = amp
-            c1,c2 = avg_conf[-2:]
-            s = (classifier.prob_threshold - c1) / (c2 - c1)
-            limit = a1 + s * (a2 - a1)
-            break
-
-    limit_entry.simulation_results = results
+    results = {}
+    def avg_confidence(amp):
+        # background results are shared by all simulations for this pair
+        if amp not in results:
+            result = strength_analysis.simulate_connection(fg_recs, bg_results, classifier, amp, rtime)
+            results[amp] = {'amp': amp, 'rise_time': rtime, 'predictions': list(result['predictions']), 'confidence': list(result['confidence'])}
+            print("    amp: %0.3g   confidence: %0.3f" % (amp, result['confidence'].mean()))
+        return np.mean(results[amp]['confidence'])
+
+    limit = find_detection_limit(avg_confidence, classifier.prob_threshold)
+
+    limit_entry.simulation_results = [results[amp] for amp in sorted(results)]
     limit_entry.minimum_amplitude = limit
 
     session.add(limit_entry)
     session.commit()
+    return limit
+
+
+def find_detection_limit(confidence, threshold, start=4e-6, max_amp=512e-6, rtol=0.1):
+    """Return the smallest amplitude at which *confidence(amp)* exceeds *threshold*, or
+    None if it does not exceed the threshold for any amplitude up to *max_amp*.
+
+    The amplitude is doubled from *start* until the threshold is crossed, then the
+    crossing is bisected until the bracket is narrower than *rtol* relative to its upper
+    end, and finally interpolated linearly within the bracket.
+
+    Non-finite confidence values (e.g. when the PSP fit failed) count as below the
+    threshold.
+    """
+    lo = 0
+    c_lo = confidence(lo)
+    if c_lo > threshold:
+        return 0
+
+    hi = start
+    c_hi = confidence(hi)
+    while not (c_hi > threshold):
+        if hi >= max_amp:
+            return None
+        lo, c_lo = hi, c_hi
+        hi = hi * 2
+        c_hi = confidence(hi)
+
+    while (hi - lo) > rtol * hi:
+        mid = 0.5 * (lo + hi)
+        c_mid = confidence(mid)
+        if c_mid > threshold:
+            hi, c_hi = mid, c_mid
+        else:
+            lo, c_lo = mid, c_mid
+
+    if not np.isfinite(c_lo):
+        # can't interpolate; the upper end of the bracket is the smallest amplitude known to cross
+        return hi
+    s = (threshold - c_lo) / (c_hi - c_lo)
+    return lo + s * (hi - lo)
+
+
+# classifier used by worker processes; set before workers are started
+_classifier = None
+
+def measure_pair_limit(pair_id):
+    """Measure the detection limit for one pair (run in a worker process).
+    """
+    session = db.Session()
+    try:
+        pair = session.query(db.Pair).filter(db.Pair.id==pair_id).all()[0]
+        return measure_limit(pair, session, _classifier)
+    finally:
+        session.close()
 
 
-def build_detection_limits():
+def build_detection_limits(parallel=True, workers=4, max_memory=None, summary_file=None):
+    """Measure detection limits for all pairs that pass QC and have not been measured yet.
+
+    Pairs are distributed among *workers* processes; workers whose memory use exceeds
+    *max_memory* bytes are replaced.
+    """
     # silence warnings about fp issues
     np.seterr(all='ignore')
 
@@ -174,40 +222,53 @@ def build_detection_limits():
     signal = filtered['confidence']
     background = filtered['ic_base_deconv_amp_mean']
 
+    # skip pairs that were already measured
     session = db.Session()
-
-    # do selected connections first
-    count = 0
-    for i,rec in enumerate(filtered):
-        print("================== %d/%d ===================== " % (i, len(filtered)))
-        pair = session.query(db.Pair).filter(db.Pair.id==rec['pair_id']).all()[0]
-        if pair.detection_limit is not None:
-            print("    skip!")
-            continue
-        try:
-            measure_limit(pair, session, classifier)
-        except Exception:
-            sys.excepthook(*sys.exc_info())
-        
-        count += 1
-        if count > 100:
-            print("Bailing out before memory fills up.")
-            sys.exit(0)
+    done = set([r[0] for r in session.query(DetectionLimit.pair_id)])
+    session.close()
+    pair_ids = [int(pid) for pid in filtered['pair_id'] if pid not in done]
+    print("Measuring detection limits for %d pairs (%d already done)" % (len(pair_ids), len(filtered) - len(pair_ids)))
+
+    # workers are forked from this process and inherit the trained classifier
+    global _classifier
+    _classifier = classifier
+
+    if parallel:
+        db.engine.dispose()
+        queue = WorkQueue(measure_pair_limit, workers=workers, max_memory=max_memory, retries=1)
+        records = queue.run(pair_ids, summary_file=summary_file)
+        failed = [rec for rec in records if rec['status'] != 'ok']
+        for rec in failed:
+            print("Pair %d failed:\n%s" % (rec['id'], rec['errors'][-1]))
+        print("Measured %d pairs, %d failed." % (len(records) - len(failed), len(failed)))
+    else:
+        for i, pair_id in enumerate(pair_ids):
+            print("================== %d/%d ===================== " % (i, len(pair_ids)))
+            try:
+                measure_pair_limit(pair_id)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--rebuild', action='store_true', default=False)
+    parser.add_argument('--local', action='store_true', default=False, help="Measure pairs one at a time in this process")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-worker-mem', type=float, default=4000, dest='max_worker_mem', help='Replace worker processes whose memory use exceeds this many MB')
+    parser.add_argument('--summary', type=str, default=None, help='Write a JSON summary of per-pair status and timing to this file')
+    parser.add_argument('--headless', action='store_true', default=False, help="Run without the debug console or confirmation prompts")
     
     args, extra = parser.parse_known_args(sys.argv[1:])
 
-    pg.dbg()
-    if args.rebuild and raw_input("Drop and rebuild detection limit table? ") == 'y':
+    if not args.headless:
+        pg.dbg()
+    if args.rebuild and (args.headless or raw_input("Drop and rebuild detection limit table? ") == 'y'):
         detection_limit_tables.drop_tables()
         init_tables()
     else:
         init_tables()
 
-    build_detection_limits()
+    build_detection_limits(parallel=not args.local, workers=args.workers, max_memory=args.max_worker_mem*1e6, summary_file=args.summary)
 
@@ -10,13 +10,14 @@ Big question: what's the best way to measure synaptic strength / connectivity?
 from __future__ import print_function, division
 
 from collections import OrderedDict
-import argparse, time, sys, os, pickle, io, multiprocessing
+import argparse, time, sys, os, pickle, io, itertools, traceback, hashlib, multiprocessing
 import numpy as np
-import scipy.stats
+import scipy.stats, scipy.signal
 import pandas
 
+import sqlalchemy
 from sqlalchemy.orm import aliased
-import sklearn.svm, sklearn.preprocessing, sklearn.ensemble
+import sklearn, sklearn.svm, sklearn.preprocessing, sklearn.ensemble, sklearn.model_selection
 
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -29,10 +30,12 @@ from neuroanalysis.baseline import float_mode
 from neuroanalysis.fitting import Psp
 
 from multipatch_analysis.database import database as db
+from multipatch_analysis.database.stream import stream_query, query_records, query_record_groups, RecordBatch
 from multipatch_analysis import config, synphys_cache
 from multipatch_analysis.ui.multipatch_nwb_viewer import MultipatchNwbViewer
 from multipatch_analysis.constants import EXCITATORY_CRE_TYPES, INHIBITORY_CRE_TYPES
-from multipatch_analysis.connection_detection import fit_psp
+from multipatch_analysis.connection_detection import fit_psp, cached_fit_psp
+from multipatch_analysis.work_queue import WorkQueue
 import multipatch_analysis.qc as qc 
 
 
@@ -58,6 +61,24 @@ class TableGroup(object):
         for k in self.schemas:
             if k not in db.engine.table_names():
                 self[k].__table__.create(bind=db.engine)
+            else:
+                self.add_missing_columns(k)
+
+    def add_missing_columns(self, table):
+        """Add columns that were added to the schema after *table* was created.
+        """
+        existing = [c['name'] for c in sqlalchemy.inspect(db.engine).get_columns(table)]
+        for col in self[table].__table__.columns:
+            if col.name in existing:
+                continue
+            coltype = col.type.compile(dialect=db.engine.dialect)
+            db.engine.execute('alter table %s add column %s %s' % (table, col.name, coltype))
+
+
+# Increment these when changes to the analysis require existing results to be recomputed
+# (see rebuild_strength(incremental=True) and stale_pairs)
+strength_analysis_version = 1
+connectivity_analysis_version = 1
 
 
 class PulseResponseStrengthTableGroup(TableGroup):
@@ -73,6 +94,7 @@ class PulseResponseStrengthTableGroup(TableGroup):
             ('pos_dec_latency', 'float'),
             ('neg_dec_latency', 'float'),
             ('crosstalk', 'float'),
+            ('analysis_version', 'int', 'Value of strength_analysis_version used to compute this record'),
         ],
         'baseline_response_strength' : [
             ('baseline_id', 'baseline.id', '', {'index': True}),
@@ -83,7 +105,14 @@ class PulseResponseStrengthTableGroup(TableGroup):
             ('pos_dec_latency', 'float'),
             ('neg_dec_latency', 'float'),
             ('crosstalk', 'float'),
-        ]
+            ('analysis_version', 'int', 'Value of strength_analysis_version used to compute this record'),
+        ],
+        'response_strength_progress': [
+            "Ranges of pulse_response / baseline IDs whose strength has been computed; used to resume an interrupted rebuild",
+            ('source', 'str', '"pulse_response" or "baseline"', {'index': True}),
+            ('start_id', 'int', 'First ID in the range'),
+            ('stop_id', 'int', 'Last ID in the range (inclusive)'),
+        ],
         #'deconv_pulse_response': [
             #"Exponentially deconvolved pulse responses",
         #],
@@ -187,6 +216,7 @@ class ConnectionStrengthTableGroup(TableGroup):
             ('vc_fit_exp_amp', 'float'),
             ('vc_fit_nrmse', 'float'),
 
+            ('analysis_version', 'int', 'Value of connectivity_analysis_version used to compute this record'),
         ],
     }
 
@@ -203,12 +233,13 @@ pulse_response_strength_tables = PulseResponseStrengthTableGroup()
 connection_strength_tables = ConnectionStrengthTableGroup()
 
 def init_tables():
-    global PulseResponseStrength, BaselineResponseStrength, ConnectionStrength
+    global PulseResponseStrength, BaselineResponseStrength, ResponseStrengthProgress, ConnectionStrength
     pulse_response_strength_tables.create_tables()
     connection_strength_tables.create_tables()
 
     PulseResponseStrength = pulse_response_strength_tables['pulse_response_strength']
     BaselineResponseStrength = pulse_response_strength_tables['baseline_response_strength']
+    ResponseStrengthProgress = pulse_response_strength_tables['response_strength_progress']
     ConnectionStrength = connection_strength_tables['connection_strength']
 
 
@@ -275,25 +306,114 @@ def remove_crosstalk_artifacts(data, pulse_times):
 
 
 @db.default_session
-def rebuild_strength(parallel=True, workers=6, session=None):
+def rebuild_strength(parallel=True, workers=6, batch_size=1000, incremental=False, session=None):
+    """Compute strength for all pulse responses and baselines that are not yet covered
+    by response_strength_progress.
+
+    Records are divided into batches of *batch_size* consecutive IDs which are handed
+    out to workers as they become idle. Each batch is committed together with its
+    progress entry, so an interrupted rebuild can be resumed by calling this again.
+
+    If *incremental* is True, then strength records computed with an older
+    strength_analysis_version are deleted, and strength is computed only for records
+    that have no strength record (regardless of response_strength_progress).
+    """
+    if incremental:
+        n = delete_stale_strength(session=session)
+        print("Removed %d out-of-date strength records" % n)
+
     for source in ['pulse_response', 'baseline']:
         print("Rebuilding %s strength table.." % source)
-        
-        # Divide workload into equal parts for each worker
-        max_pulse_id = session.execute('select max(id) from %s' % source).fetchone()[0]
-        chunk = 1 + (max_pulse_id // workers)
-        parts = [(source, chunk*i, chunk*(i+1)) for i in range(workers)]
+        batches = strength_batches(source, batch_size, incremental=incremental, session=session)
+        batches = [(source, start, stop) for start, stop in batches]
+        print("    %d batches remaining" % len(batches))
 
         if parallel:
-            pool = multiprocessing.Pool(processes=workers)
-            pool.map(compute_strength, parts)
+            # Dispose DB engine before forking; see import_to_database
+            session.close()
+            db.engine.dispose()
+            queue = WorkQueue(compute_strength, workers=workers, retries=1)
+            records = queue.run(batches)
+            failed = [rec for rec in records if rec['status'] != 'ok']
+            if len(failed) > 0:
+                print("    %d batches failed; run again to retry:" % len(failed))
+                for rec in failed:
+                    print("        %s:\n%s" % (rec['id'], rec['errors'][-1]))
         else:
-            for part in parts:
-                compute_strength(part)
+            for batch in batches:
+                compute_strength(batch)
+
+
+strength_tables = {'pulse_response': 'pulse_response_strength', 'baseline': 'baseline_response_strength'}
+
+
+@db.default_session
+def strength_batches(source, batch_size, incremental=False, session=None):
+    """Return a list of (start_id, stop_id) ranges (inclusive) that each contain up to
+    *batch_size* records from the *source* table, skipping ranges already recorded in
+    response_strength_progress.
+
+    If *incremental* is True, then batches are built from only the records that have
+    no strength record, and response_strength_progress is ignored.
+
+    Batch boundaries are found by keyset pagination, so gaps in the ID space do not
+    produce empty or uneven batches.
+    """
+    if incremental:
+        done = []
+        missing = ' and not exists (select 1 from {st} where {st}.{src}_id = {src}.id)'.format(st=strength_tables[source], src=source)
+    else:
+        done = session.query(ResponseStrengthProgress.start_id, ResponseStrengthProgress.stop_id)
+        done = sorted(done.filter(ResponseStrengthProgress.source==source).all())
+        missing = ''
+
+    batches = []
+    last_id = -1
+    i = 0
+    while True:
+        # skip over completed ranges
+        while i < len(done) and done[i][0] <= last_id + 1:
+            last_id = max(last_id, done[i][1])
+            i += 1
+        # don't let the next batch run into a completed range
+        limit = done[i][0] if i < len(done) else None
+
+        where = 'id > %d' % last_id + missing
+        if limit is not None:
+            where += ' and id < %d' % limit
+        stop = session.execute('select id from %s where %s order by id offset %d limit 1' % (source, where, batch_size-1)).fetchone()
+        if stop is None:
+            stop = session.execute('select max(id) from %s where %s' % (source, where)).fetchone()
+        stop = stop[0]
+
+        if stop is None:
+            if limit is None:
+                break
+            # nothing left before the next completed range
+            last_id = limit - 1
+            continue
+
+        batches.append((last_id + 1, stop))
+        last_id = stop
+    return batches
+
+
+@db.default_session
+def delete_stale_strength(session=None):
+    """Delete strength records that were computed with an older strength_analysis_version.
+
+    Return the number of records deleted.
+    """
+    n = 0
+    for table in (PulseResponseStrength, BaselineResponseStrength):
+        q = session.query(table).filter((table.analysis_version == None) | (table.analysis_version < strength_analysis_version))
+        n += q.delete(synchronize_session=False)
+    session.commit()
+    return n
 
 
 def compute_strength(inds, session=None):
-    # Thin wrapper just to allow calling from pool.map
+    # Thin wrapper just to allow calling from a worker process
     return _compute_strength(inds, session=session)
 
 
@@ -399,88 +519,380 @@ def analyze_response_strength(rec, source, remove_artifacts=False, lpf=True, bsu
     return results
 
 
+strength_keys = ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']
+
+
+def analyze_response_strength_batch(recs, source, lpf=True, bsub=True, lowpass=1000):
+    """Vectorized equivalent of analyze_response_strength for many records at once.
+
+    Records are grouped by snippet length, and each group is analyzed as a 2D
+    array. Artifact removal is not supported (use analyze_response_strength).
+
+    *recs* may be a sequence of records (as returned by response_query or baseline_query)
+    or a RecordBatch from stream_query.
+
+    Returns a dict of arrays (one value per record) for each of *strength_keys*.
+    """
+    n = len(recs)
+    results = {k: np.empty(n) for k in strength_keys}
+    if n == 0:
+        return results
+
+    if source == 'pulse_response':
+        rec_start = np.array(_record_column(recs, 'rec_start'), dtype=float)
+        pulse_start = np.array(_record_column(recs, 'pulse_start'), dtype=float) - rec_start
+        # records without a spike failed QC, but we analyze them anyway to make all data visible
+        spike_time = np.array(_record_column(recs, 'spike_time'), dtype=float)
+        spike_time = np.where(np.isnan(spike_time), 11e-3, spike_time - rec_start)
+    elif source == 'baseline':
+        # same fake stimulus timing as analyze_response_strength
+        pulse_start = np.full(n, 10e-3)
+        spike_time = np.full(n, 11e-3)
+    else:
+        raise ValueError("Invalid source %s" % source)
+    tau = np.array([15e-3 if mode == 'ic' else 5e-3 for mode in _record_column(recs, 'clamp_mode')])
+
+    rec_data = _record_column(recs, 'data')
+    lengths = np.array([len(d) for d in rec_data])
+    for length in np.unique(lengths):
+        rows = np.argwhere(lengths == length)[:, 0]
+        data = np.vstack([rec_data[i] for i in rows])
+        block = _strength_block(data, pulse_start[rows], spike_time[rows], tau[rows], lpf=lpf, bsub=bsub, lowpass=lowpass)
+        for k in strength_keys:
+            results[k][rows] = block[k]
+    return results
+
+
+def _record_column(recs, name):
+    # values of one field for all records, from either a RecordBatch or a sequence of records
+    if isinstance(recs, RecordBatch):
+        return recs[name]
+    return [getattr(rec, name) for rec in recs]
+
+
+def _strength_block(data, pulse_start, spike_time, tau, lpf, bsub, lowpass, sample_rate=db.default_sample_rate):
+    """Compute strength metrics for a 2D array of equal-length snippets (one per row).
+    """
+    dt = 1.0 / sample_rate
+    results = {}
+
+    # crosstalk from pulse onset
+    p1 = _median_rows(data, _time_index(pulse_start - 200e-6, sample_rate, data.shape[1]), _time_index(pulse_start, sample_rate, data.shape[1]))
+    p2 = _median_rows(data, _time_index(pulse_start, sample_rate, data.shape[1]), _time_index(pulse_start + 200e-6, sample_rate, data.shape[1]))
+    results['crosstalk'] = p2 - p1
+
+    # deflection on raw data
+    results['pos_amp'], _ = _measure_peak_rows(data, '+', spike_time, pulse_start, sample_rate)
+    results['neg_amp'], _ = _measure_peak_rows(data, '-', spike_time, pulse_start, sample_rate)
+
+    # deconvolution / baseline subtraction / filtering (see deconv_filter)
+    dec = data[:, :-1] + (tau / dt)[:, None] * np.diff(data, axis=1)
+    if bsub:
+        n_dec = dec.shape[1]
+        baseline = np.median(dec[:, _time_index(5e-3, sample_rate, n_dec):_time_index(10e-3, sample_rate, n_dec)], axis=1)
+        dec = dec - baseline[:, None]
+    if lpf:
+        b, a = scipy.signal.bessel(1, lowpass * dt, btype='low')
+        dec = _apply_filter_rows(dec, b, a)
+
+    # deflection on deconvolved data
+    results['pos_dec_amp'], results['pos_dec_latency'] = _measure_peak_rows(dec, '+', spike_time, pulse_start, sample_rate)
+    results['neg_dec_amp'], results['neg_dec_latency'] = _measure_peak_rows(dec, '-', spike_time, pulse_start, sample_rate)
+    return results
+
+
+def _time_index(t, sample_rate, n):
+    # same as Trace.index_at for a trace with t0=0
+    return np.clip(np.round(np.asarray(t) * sample_rate).astype(int), 0, n - 1)
+
+
+def _window_rows(data, start, stop, fill):
+    """Return (values, valid), where row i of *values* holds data[i, start[i]:stop[i]]
+    padded with *fill*.
+    """
+    width = max(1, (stop - start).max())
+    idx = start[:, None] + np.arange(width)[None, :]
+    valid = idx < stop[:, None]
+    values = data[np.arange(data.shape[0])[:, None], np.clip(idx, 0, data.shape[1] - 1)]
+    return np.where(valid, values, fill), valid
+
+
+def _median_rows(data, start, stop):
+    values, valid = _window_rows(data, start, stop, np.nan)
+    return np.nanmedian(values, axis=1)
+
+
+def _float_mode_rows(data, start, stop):
+    """Row-wise equivalent of float_mode(data[i, start[i]:stop[i]]).
+
+    Bin edges and bin assignment follow np.histogram, so results match
+    float_mode for each row (up to rounding of float32 bin edges).
+    """
+    n = data.shape[0]
+    rows = np.arange(n)[:, None]
+    values, valid = _window_rows(data, start, stop, 0)
+    count = valid.sum(axis=1)
+    bins = np.clip((count ** 0.5).astype(int), 3, 500)
+
+    lo = np.where(valid, values, np.inf).min(axis=1).astype(float)
+    hi = np.where(valid, values, -np.inf).max(axis=1).astype(float)
+    empty = count == 0
+    lo[empty] = 0
+    hi[empty] = 1
+    same = lo == hi
+    lo[same] -= 0.5
+    hi[same] += 0.5
+
+    # bin edges as generated by np.linspace(lo, hi, bins+1)
+    n_bins = bins.max()
+    edges = np.arange(n_bins + 1)[None, :] * ((hi - lo) / bins)[:, None] + lo[:, None]
+    edges[rows[:, 0], bins] = hi
+    edges = edges.astype(np.result_type(data.dtype, np.float32))
+    values = np.where(valid, values, lo[:, None]).astype(edges.dtype)
+
+    # bin index of each value, with the same edge corrections as np.histogram
+    idx = np.floor((values - lo[:, None]) / (hi - lo)[:, None] * bins[:, None]).astype(int)
+    idx = np.clip(idx, 0, bins[:, None] - 1)
+    idx -= values < edges[rows, idx]
+    idx = np.clip(idx, 0, None)
+    idx += (values >= edges[rows, idx + 1]) & (idx != bins[:, None] - 1)
+
+    counts = np.bincount((rows * n_bins + idx)[valid], minlength=n * n_bins).reshape(n, n_bins)
+    ind = counts.argmax(axis=1)
+    return 0.5 * (edges[rows[:, 0], ind] + edges[rows[:, 0], ind + 1])
+
+
+def _measure_peak_rows(data, sign, spike_time, pulse_start, sample_rate, spike_delay=1e-3, response_window=4e-3):
+    """Row-wise equivalent of measure_peak; returns arrays (amp, latency).
+    """
+    n_samples = data.shape[1]
+    baseline = _float_mode_rows(data, np.zeros(len(data), dtype=int), _time_index(pulse_start - 50e-6, sample_rate, n_samples))
+
+    response_start = spike_time + spike_delay
+    response_stop = response_start + response_window
+    i1 = _time_index(response_start, sample_rate, n_samples)
+    i2 = _time_index(response_stop, sample_rate, n_samples)
+    values, valid = _window_rows(data, i1, i2, -np.inf if sign == '+' else np.inf)
+    i = np.argmax(values, axis=1) if sign == '+' else np.argmin(values, axis=1)
+    peak = values[np.arange(len(data)), i]
+    latency = (i1 + i) * (1.0 / sample_rate) - spike_time
+
+    # empty response windows have no peak
+    empty = ~valid.any(axis=1)
+    peak = np.where(empty, np.nan, peak)
+    latency = np.where(empty, np.nan, latency)
+    return peak - baseline, latency
+
+
+def _apply_filter_rows(data, b, a, padding=100):
+    # same as neuroanalysis.filter.apply_filter (bidirectional, reflection-padded), applied to each row
+    padding = min(padding, data.shape[1])
+    padded = np.hstack([data[:, :padding][:, ::-1], data, data[:, -padding:][:, ::-1]])
+    filtered = scipy.signal.lfilter(b, a, scipy.signal.lfilter(b, a, padded, axis=1)[:, ::-1], axis=1)[:, ::-1]
+    return filtered[:, padding:padded.shape[1]-padding]
+
+
+def compare_strength_methods(recs, source, rtol=1e-4):
+    """Compare the output of analyze_response_strength_batch against analyze_response_strength
+    for the given records.
+
+    Returns a dict giving, for each metric, (max absolute difference, bool indicating
+    whether the results agree within *rtol* relative to the largest value).
+    """
+    batch = analyze_response_strength_batch(recs, source)
+    single = {k: np.empty(len(recs)) for k in strength_keys}
+    for i, rec in enumerate(recs):
+        result = analyze_response_strength(rec, source)
+        for k in strength_keys:
+            single[k][i] = result[k]
+
+    report = {}
+    for k in strength_keys:
+        scale = np.nanmax(np.abs(single[k])) if np.any(np.isfinite(single[k])) else 0
+        diff = np.abs(batch[k] - single[k])
+        max_diff = np.nanmax(diff) if np.any(np.isfinite(diff)) else 0
+        ok = np.allclose(batch[k], single[k], rtol=rtol, atol=rtol * scale, equal_nan=True)
+        report[k] = (max_diff, ok)
+    return report
+
+
+@db.default_session
+def check_strength_batch(n_recs=1000, session=None):
+    """Print a comparison of batch and per-record strength analysis for the first
+    *n_recs* pulse response and baseline records.
+    """
+    for source, q in [('pulse_response', response_query(session).order_by(db.PulseResponse.id)),
+                      ('baseline', baseline_query(session).order_by(db.Baseline.id))]:
+        recs = q.limit(n_recs).all()
+        print("%s (%d records):" % (source, len(recs)))
+        for k, (max_diff, ok) in sorted(compare_strength_methods(recs, source).items()):
+            print("    %s  max diff: %g  %s" % (k.ljust(16), max_diff, 'ok' if ok else 'MISMATCH'))
+
+
 @db.default_session
 def _compute_strength(inds, session=None):
-    """Comput per-pulse-response strength metrics
+    """Compute per-pulse-response strength metrics for records with IDs in [start_id, stop_id].
+
+    Results are committed in a single transaction together with a response_strength_progress
+    entry for the range.
     """
     source, start_id, stop_id = inds
     if source == 'baseline':
         q = baseline_query(session)
+        id_col = db.Baseline.id
+        table = BaselineResponseStrength
     elif source == 'pulse_response':
         q = response_query(session)
+        id_col = db.PulseResponse.id
+        table = PulseResponseStrength
     else:
         raise ValueError("Invalid source %s" % source)
 
-    prof = pg.debug.Profiler(delayed=False)
-    
-    next_id = start_id
-    while True:
-        # Request just a chunk of all pulse responses based on ID range
-        if source == 'pulse_response':
-            q1 = q.filter(db.PulseResponse.id>=next_id).filter(db.PulseResponse.id<stop_id)
-            q1 = q1.order_by(db.PulseResponse.id)
-        else:
-            q1 = q.filter(db.Baseline.id>=next_id).filter(db.Baseline.id<stop_id)
-            q1 = q1.order_by(db.Baseline.id)
-        q1 = q1.limit(1000)  # process in 1000-record chunks
-
-        prof('exec')
-        recs = q1.all()
-        prof('fetch')
-        if len(recs) == 0:
-            break
-        new_recs = []
+    # skip records that already have strength computed
+    q = q.outerjoin(table, getattr(table, '%s_id' % source) == id_col).filter(table.id == None)
 
-        for rec in recs:
-            result = analyze_response_strength(rec, source)
-            new_rec = {'%s_id'%source: rec.response_id}
-            # copy a subset of results over to new record
-            for k in ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']:
-                new_rec[k] = result[k]
+    # Stream the ID range from a server-side cursor in 1000-record batches
+    q = q.filter(id_col>=start_id).filter(id_col<=stop_id).order_by(id_col)
+    for batch in stream_query(q, batch_size=1000):
+        results = analyze_response_strength_batch(batch, source)
+        new_recs = []
+        for i, response_id in enumerate(batch['response_id']):
+            new_rec = {'%s_id'%source: int(response_id), 'analysis_version': strength_analysis_version}
+            for k in strength_keys:
+                new_rec[k] = float(results[k][i])
             new_recs.append(new_rec)
-        
-        next_id = rec.response_id + 1
-        
-        sys.stdout.write("%d / %d\r" % (next_id-start_id, stop_id-start_id))
-        sys.stdout.flush()
+        session.bulk_insert_mappings(table, new_recs)
 
-        prof('process')
-        if source == 'pulse_response':
-            session.bulk_insert_mappings(PulseResponseStrength, new_recs)
-        else:
-            session.bulk_insert_mappings(BaselineResponseStrength, new_recs)
-        prof('insert')
-        new_recs = []
+    session.add(ResponseStrengthProgress(source=source, start_id=start_id, stop_id=stop_id))
+    session.commit()
+
+
+@db.default_session
+def rebuild_connectivity(session, pair_ids=None, parallel=False, workers=6):
+    """Compute connection_strength records for all pairs, or only for the pairs in *pair_ids*
+    (any existing records for these pairs are replaced).
+
+    Work is divided by experiment; if *parallel* is True, experiments are distributed
+    among *workers* processes. Pairs whose analysis fails are skipped and reported, as are
+    pairs whose average response could not be fit.
+    Return a dict of {pair_id: error message} for these pairs.
+    """
+    print("Rebuilding connectivity table..")
 
+    if pair_ids is None:
+        expt_ids = [r[0] for r in session.query(db.Experiment.id).order_by(db.Experiment.id)]
+        tasks = [(expt_id, None) for expt_id in expt_ids]
+    else:
+        q = session.query(ConnectionStrength).filter(ConnectionStrength.pair_id.in_(pair_ids))
+        q.delete(synchronize_session=False)
         session.commit()
-        prof('commit')
+        pairs = session.query(db.Pair.experiment_id, db.Pair.id).filter(db.Pair.id.in_(pair_ids))
+        pairs = pairs.order_by(db.Pair.experiment_id, db.Pair.id).all()
+        tasks = [(expt_id, tuple([p[1] for p in g])) for expt_id, g in itertools.groupby(pairs, key=lambda p: p[0])]
+
+    errors = {}
+    if parallel:
+        # Dispose DB engine before forking; each worker then opens its own connections
+        session.close()
+        db.engine.dispose()
+        queue = WorkQueue(compute_connectivity, workers=workers, retries=1)
+        for rec in queue.run(tasks):
+            if rec['status'] == 'ok':
+                errors.update(rec['result'])
+            else:
+                print("Failed to analyze experiment %s:\n%s" % (rec['id'][0], rec['errors'][-1]))
+    else:
+        for i, task in enumerate(tasks):
+            errors.update(compute_connectivity(task))
+            sys.stdout.write("%d / %d       \r" % (i, len(tasks)))
+            sys.stdout.flush()
+
+    if len(errors) > 0:
+        print("Connectivity analysis errors for %d pairs:" % len(errors))
+        for pair_id, err in sorted(errors.items()):
+            print("    pair %d: %s" % (pair_id, err))
+    return errors
+
+
+def compute_connectivity(task, session=None):
+    # Thin wrapper just to allow calling from a worker process
+    return _compute_connectivity(task, session=session)
 
 
 @db.default_session
-def rebuild_connectivity(session):
-    print("Rebuilding connectivity table..")
-    
-    expts_in_db = list_experiments(session=session)
-    for i,expt in enumerate(expts_in_db):
-        for pair in expt.pairs:
-            # Query all pulse amplitude records for each clamp mode
-            amps = {}
-            for clamp_mode in ('ic', 'vc'):
-                clamp_mode_fg = get_amps(session, pair, clamp_mode=clamp_mode, get_data=True)
-                clamp_mode_bg = get_baseline_amps(session, pair, amps=clamp_mode_fg, clamp_mode=clamp_mode, get_data=False)
-                amps[clamp_mode, 'fg'] = clamp_mode_fg
-                amps[clamp_mode, 'bg'] = clamp_mode_bg
-            
+def _compute_connectivity(task, session=None):
+    """Compute connection_strength records for all pairs in one experiment (or for the
+    subset of pairs given in *task*), and insert them in a single transaction.
+
+    Return a dict of {pair_id: error message} for pairs whose analysis failed (or whose
+    average response could not be fit; these pairs are still recorded).
+    """
+    expt_id, pair_ids = task
+
+    # Query all pulse amplitude records for each pair and clamp mode in this experiment
+    expt_amps = get_experiment_amps(session, [expt_id], get_data=True)
+    if pair_ids is None:
+        pair_ids = sorted(expt_amps.keys())
+
+    new_recs = []
+    errors = {}
+    for pair_id in pair_ids:
+        fit_errors = {}
+        try:
             # Generate summary results for this pair
-            results = analyze_pair_connectivity(amps)
-            
-            # Write new record to DB
-            conn = ConnectionStrength(pair_id=pair.id, **results)
-            session.add(conn)
-        
-        session.commit()
-        sys.stdout.write("%d / %d       \r" % (i, len(expts_in_db)))
-        sys.stdout.flush()
+            results = analyze_pair_connectivity(expt_amps[pair_id], fit_errors=fit_errors)
+        except Exception:
+            errors[pair_id] = traceback.format_exc().strip().split('\n')[-1]
+            continue
+        if len(fit_errors) > 0:
+            errors[pair_id] = '; '.join(['%s PSP fit: %s' % item for item in sorted(fit_errors.items())])
+        results['pair_id'] = pair_id
+        results['analysis_version'] = connectivity_analysis_version
+        new_recs.append(results)
+
+    session.bulk_insert_mappings(ConnectionStrength, new_recs)
+    session.commit()
+    return errors
+
+
+@db.default_session
+def stale_pairs(session=None):
+    """Return IDs of pairs whose connection_strength record is missing, was computed with
+    an older connectivity_analysis_version, or is older than any of the pulse response or
+    baseline strength records it depends on.
+    """
+    q = """
+        select pair.id from pair
+        left join connection_strength cs on cs.pair_id = pair.id
+        where cs.id is null
+        or cs.analysis_version is null
+        or cs.analysis_version < :version
+        or exists (
+            select 1 from pulse_response pr
+            join pulse_response_strength prs on prs.pulse_response_id = pr.id
+            where pr.pair_id = pair.id and prs.time_created > cs.time_created
+        )
+        or exists (
+            select 1 from baseline b
+            join baseline_response_strength brs on brs.baseline_id = b.id
+            join recording r on b.recording_id = r.id
+            join sync_rec sr on r.sync_rec_id = sr.id
+            where sr.experiment_id = pair.experiment_id and brs.time_created > cs.time_created
+        )
+    """
+    return [r[0] for r in session.execute(q, {'version': connectivity_analysis_version})]
+
+
+def update_strength(parallel=True, workers=6):
+    """Bring strength and connectivity tables up to date: compute strength only for new
+    or out-of-date pulse responses and baselines, then recompute connectivity only for
+    the affected pairs.
+    """
+    rebuild_strength(parallel=parallel, workers=workers, incremental=True)
+    pair_ids = stale_pairs()
+    print("Updating connectivity for %d pairs.." % len(pair_ids))
+    if len(pair_ids) > 0:
+        rebuild_connectivity(pair_ids=pair_ids, parallel=parallel, workers=workers)
 
 
 def norm_pvalue(pval):
@@ -494,7 +906,7 @@ def norm_pvalue(pval):
     return min(7, np.log(1-np.log(pval)))
 
 
-def analyze_pair_connectivity(amps, sign=None):
+def analyze_pair_connectivity(amps, sign=None, fit_errors=None, use_cache=True):
     """Given response strength records for a single pair, generate summary
     statistics characterizing strength, latency, and connectivity.
     
@@ -506,6 +918,14 @@ def analyze_pair_connectivity(amps, sign=None):
     sign : None, -1, or +1
         If None, then automatically determine whether to treat this connection as
         inhibitory or excitatory.
+    fit_errors : dict | None
+        If a dict is given, errors in the PSP fit to the average response are
+        recorded in it as {clamp_mode: message} and the fit fields for that clamp
+        mode are left empty. Otherwise, fit errors are raised.
+    use_cache : bool
+        If True, the PSP fit to the average response is read from / stored in the
+        fit cache (see multipatch_analysis.fit_cache). Use False for data that will
+        not be analyzed again, such as simulated responses.
 
     Input must have the following structure::
     
@@ -645,14 +1065,15 @@ def analyze_pair_connectivity(amps, sign=None):
         sign = {'pos':'+', 'neg':'-'}[signs[clamp_mode]]
         fg_bsub = fg_avg.copy(data=fg_avg.data - base)  # remove base to help fitting
         try:
-            fit = fit_psp(fg_bsub, mode=clamp_mode, sign=sign, xoffset=(1e-3, 0, 6e-3), yoffset=0, mask_stim_artifact=False, rise_time_mult_factor=4)            
+            fit = (cached_fit_psp if use_cache else fit_psp)(fg_bsub, mode=clamp_mode, sign=sign, xoffset=(1e-3, 0, 6e-3), yoffset=0, mask_stim_artifact=False, rise_time_mult_factor=4)            
             for param, val in fit.best_values.items():
                 fields['%s_fit_%s' % (clamp_mode, param)] = val
             fields[clamp_mode + '_fit_yoffset'] = fit.best_values['yoffset'] + base
             fields[clamp_mode + '_fit_nrmse'] = fit.nrmse()
-        except:
-            print("Error in PSP fit:")
-            sys.excepthook(*sys.exc_info())
+        except Exception:
+            if fit_errors is None:
+                raise
+            fit_errors[clamp_mode] = traceback.format_exc().strip().split('\n')[-1]
             continue
         
         #global fit_plot
@@ -749,6 +1170,24 @@ class ExperimentBrowser(pg.TreeWidget):
 def get_amps(session, pair, clamp_mode='ic', get_data=False):
     """Select records from pulse_response_strength table
     """
+    q, pre_rec, post_rec = amps_query(session, get_data=get_data)
+        
+    filters = [
+        (pre_rec.electrode==pair.pre_cell.electrode,),
+        (post_rec.electrode==pair.post_cell.electrode,),
+        (db.PatchClampRecording.clamp_mode==clamp_mode,),
+    ]
+    for filter_args in filters:
+        q = q.filter(*filter_args)
+    
+    return query_records(q)
+
+
+def amps_query(session, get_data=False):
+    """Build the query used by get_amps, without pair or clamp mode filters.
+
+    Return (query, pre_rec, post_rec).
+    """
     cols = [
         PulseResponseStrength.id,
         PulseResponseStrength.pos_amp,
@@ -774,22 +1213,11 @@ def get_amps(session, pair, clamp_mode='ic', get_data=False):
     q, pre_rec, post_rec = join_pulse_response_to_expt(q)
     q = q.join(db.StimSpike)
     q = q.add_columns(post_rec.start_time.label('rec_start_time'))
-        
-    filters = [
-        (pre_rec.electrode==pair.pre_cell.electrode,),
-        (post_rec.electrode==pair.post_cell.electrode,),
-        (db.PatchClampRecording.clamp_mode==clamp_mode,),
-        (db.PatchClampRecording.qc_pass==True,),
-    ]
-    for filter_args in filters:
-        q = q.filter(*filter_args)
-    
+    q = q.filter(db.PatchClampRecording.qc_pass==True)
+
     # should result in chronological order
     q = q.order_by(db.PulseResponse.id)
-
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
-    return recs
+    return q, pre_rec, post_rec
 
 
 def get_baseline_amps_NO_ORM_VERSION(session, expt, dev, clamp_mode='ic'):
@@ -823,6 +1251,29 @@ def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
     If *amps* is given (output from get_amps), then baseline records will be selected from the same
     sweeps as the responses.
     """
+    q = baseline_amps_query(session, get_data=get_data)
+    
+    filters = [
+        (db.Recording.electrode==pair.post_cell.electrode,),
+        (db.PatchClampRecording.clamp_mode==clamp_mode,),
+    ]
+    for filter_args in filters:
+        q = q.filter(*filter_args)
+    
+    # if amps is not None:
+    #     q = q.limit(len(amps))
+
+    recs = query_records(q)
+
+    if amps is not None:
+        recs = recs[nearest_baseline_mask(amps, recs)]
+
+    return recs
+
+
+def baseline_amps_query(session, get_data=True):
+    """Build the query used by get_baseline_amps, without pair or clamp mode filters.
+    """
     cols = [
         BaselineResponseStrength.id,
         BaselineResponseStrength.pos_amp,
@@ -843,39 +1294,133 @@ def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
         
     q = session.query(*cols)
     q = q.join(db.Baseline).join(db.Recording).join(db.PatchClampRecording).join(db.SyncRec).join(db.Experiment)
-    
-    filters = [
-        (db.Recording.electrode==pair.post_cell.electrode,),
-        (db.PatchClampRecording.clamp_mode==clamp_mode,),
-        (db.PatchClampRecording.qc_pass==True,),
-    ]
-    for filter_args in filters:
-        q = q.filter(*filter_args)
-    
+    q = q.filter(db.PatchClampRecording.qc_pass==True)
+
     # should result in chronological order
-    q = q.order_by(db.Recording.start_time)
+    q = q.order_by(db.Recording.start_time, db.Baseline.id)
+    return q
 
-    # if amps is not None:
-    #     q = q.limit(len(amps))
 
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
+def nearest_baseline_mask(amps, base_recs):
+    """Return a boolean mask selecting, for each record in *amps* (from get_amps), the nearest
+    (in time) record in *base_recs* that has not already been selected.
+    """
+    amp_times = amps['rec_start_time'].astype(float)*1e-9 + amps['response_start_time']
+    base_times = base_recs['rec_start_time'].astype(float)*1e-9 + base_recs['response_start_time']
+    mask = np.zeros(len(base_recs), dtype=bool)
+    inds = match_nearest_unused(amp_times, base_times)
+    mask[inds[inds >= 0]] = True
+    return mask
 
-    if amps is not None:
-        # for each record returned from get_amps, return the nearest baseline record
-        mask = np.zeros(len(recs), dtype=bool)
-        amp_times = amps['rec_start_time'].astype(float)*1e-9 + amps['response_start_time']
-        base_times = recs['rec_start_time'].astype(float)*1e-9 + recs['response_start_time']
-        for i in range(len(amps)):
-            order = np.argsort(np.abs(base_times - amp_times[i]))
-            for j in order:
-                if mask[j]:
-                    continue
-                mask[j] = True
-                break
-        recs = recs[mask]
 
-    return recs
+def match_nearest_unused(times, candidates):
+    """Greedily match each value in *times* (in order) to the nearest value in *candidates*
+    that has not already been matched.
+
+    Returns an array of candidate indices, one per value in *times*; values that could
+    not be matched because all candidates were used get -1. When two candidates are equally
+    near, the one with the lower index is used.
+
+    Candidates are sorted once and used slots are skipped with a pair of union-find
+    structures (nearest free slot to the left / right), so the cost is O((n+m) log m)
+    rather than sorting all candidates for each time.
+    """
+    times = np.asarray(times, dtype=float)
+    candidates = np.asarray(candidates, dtype=float)
+    result = np.empty(len(times), dtype=int)
+    result[:] = -1
+    if len(times) == 0 or len(candidates) == 0:
+        return result
+
+    # group candidates by unique value; within each group, indices are in increasing order
+    order = np.argsort(candidates, kind='mergesort')
+    uniq, starts = np.unique(candidates[order], return_index=True)
+    ends = list(starts[1:]) + [len(order)]
+    next_free = list(starts)
+    order = list(order)
+    values = list(uniq)
+
+    # slots 1..n_uniq correspond to unique values; 0 and n_uniq+1 are sentinels
+    n_uniq = len(values)
+    left = list(range(n_uniq + 2))
+    right = list(range(n_uniq + 2))
+
+    def find(parent, k):
+        root = k
+        while parent[root] != root:
+            root = parent[root]
+        while parent[k] != root:
+            parent[k], k = root, parent[k]
+        return root
+
+    insert = np.searchsorted(uniq, times)
+    for i, t in enumerate(times):
+        l = find(left, insert[i])
+        r = find(right, insert[i] + 1)
+        if l == 0 and r == n_uniq + 1:
+            break
+        if l == 0:
+            k = r
+        elif r == n_uniq + 1:
+            k = l
+        else:
+            dl = abs(values[l-1] - t)
+            dr = abs(values[r-1] - t)
+            if dl < dr or (dl == dr and order[next_free[l-1]] < order[next_free[r-1]]):
+                k = l
+            else:
+                k = r
+
+        group = k - 1
+        result[i] = order[next_free[group]]
+        next_free[group] += 1
+        if next_free[group] == ends[group]:
+            # no unused candidates left with this value
+            left[k] = k - 1
+            right[k] = k + 1
+    return result
+
+
+def get_experiment_amps(session, expt_ids, clamp_modes=('ic', 'vc'), get_data=True):
+    """Load pulse response and baseline strength records for all pairs in a set of experiments.
+
+    This runs one query for pulse responses and one for baselines, and splits the results
+    into per-pair record arrays in memory, rather than querying each pair separately.
+
+    Returns {pair_id: amps}, where amps is the dict expected by analyze_pair_connectivity:
+    amps[clamp_mode, 'fg'] has the same records as get_amps(..., get_data=get_data), and
+    amps[clamp_mode, 'bg'] the same as get_baseline_amps(..., amps=fg, get_data=False).
+    Like those functions, records have the query's fields only (no pandas 'index' field).
+    """
+    expt_ids = list(expt_ids)
+    pre_cell = aliased(db.Cell)
+    post_cell = aliased(db.Cell)
+    pairs = session.query(db.Pair.id, pre_cell.electrode_id, post_cell.electrode_id)
+    pairs = pairs.join(pre_cell, db.Pair.pre_cell_id==pre_cell.id).join(post_cell, db.Pair.post_cell_id==post_cell.id)
+    pairs = pairs.filter(db.Pair.experiment_id.in_(expt_ids)).order_by(db.Pair.id).all()
+
+    # records are streamed and grouped by electrode as they are read, rather than
+    # loading every record (and data array) of the experiments at once
+    q, pre_rec, post_rec = amps_query(session, get_data=get_data)
+    q = q.add_columns(pre_rec.electrode_id.label('pre_electrode_id'), post_rec.electrode_id.label('post_electrode_id'))
+    q = q.filter(db.Experiment.id.in_(expt_ids))
+    fg_groups, fg_dtype = query_record_groups(q, ['pre_electrode_id', 'post_electrode_id', 'clamp_mode'])
+
+    q = baseline_amps_query(session, get_data=False)
+    q = q.add_columns(db.Recording.electrode_id.label('electrode_id'))
+    q = q.filter(db.Experiment.id.in_(expt_ids))
+    bg_groups, bg_dtype = query_record_groups(q, ['electrode_id', 'clamp_mode'])
+
+    results = {}
+    for pair_id, pre_elec, post_elec in pairs:
+        amps = {}
+        for clamp_mode in clamp_modes:
+            fg_recs = fg_groups.get((pre_elec, post_elec, clamp_mode), np.empty(0, dtype=fg_dtype))
+            bg_recs = bg_groups.get((post_elec, clamp_mode), np.empty(0, dtype=bg_dtype))
+            amps[clamp_mode, 'fg'] = fg_recs
+            amps[clamp_mode, 'bg'] = bg_recs[nearest_baseline_mask(fg_recs, bg_recs)]
+        results[pair_id] = amps
+    return results
 
 
 def join_pulse_response_to_expt(query):
@@ -1348,8 +1893,8 @@ def query_all_pairs(classifier=None):
     if classifier is None:
         return recs
 
-    # Fit classifier and add results of classifier prediction in to records
-    classifier.fit(recs)
+    # Fit classifier (or load a previously trained model) and add results of classifier prediction in to records
+    classifier.fit_cached(recs)
     prediction = classifier.predict(recs)
     recs = join_struct_arrays([recs, prediction])
     return recs
@@ -1403,8 +1948,15 @@ class PairClassifier(object):
     """Supervised classifier used to predict whether a cell pair is synaptically connected.
 
     Input records should be similar to those generated by query_all_pairs()
+
+    Trained models are saved to the synphys cache directory; fit_cached() reloads a
+    saved model if it was trained on the same data with the same settings.
+    Hyperparameter search is distributed over *n_jobs* processes (-1 uses all cores).
     """
-    def __init__(self, seed=None, use_vc_features=True):
+    # increment to invalidate saved models when the training procedure changes
+    version = 1
+
+    def __init__(self, seed=None, use_vc_features=True, n_jobs=-1):
         ic_features = [
             # 'ic_amp_mean',
             # 'ic_amp_stdev',
@@ -1456,12 +2008,95 @@ class PairClassifier(object):
 
         # Random seed used when shuffling training/test inputs
         self.seed = seed
+        self.n_jobs = n_jobs
+        self.fingerprint = None
+
+    def fit_cached(self, recs, cache_file=None):
+        """Load a saved model from *cache_file* if it was trained on the same records,
+        otherwise fit and save a new model.
+
+        If *cache_file* is None, a file in the synphys cache directory is chosen based
+        on the feature list and random seed.
+        """
+        if cache_file is None:
+            cache_file = self.default_cache_file()
+        fingerprint = self.training_fingerprint(recs)
+        if os.path.isfile(cache_file):
+            try:
+                if self.load(cache_file, fingerprint):
+                    print("Loaded pair classifier from %s" % cache_file)
+                    return
+            except Exception:
+                print("Could not load pair classifier from %s:" % cache_file)
+                sys.excepthook(*sys.exc_info())
+        self.fit(recs)
+        self.fingerprint = fingerprint
+        self.save(cache_file)
+
+    def default_cache_file(self):
+        key = hashlib.sha1(repr((self.features, self.seed)).encode('utf8')).hexdigest()[:12]
+        return os.path.join(synphys_cache.get_cache().local_path, 'pair_classifier_%s.pkl' % key)
+
+    def training_fingerprint(self, recs):
+        """Return a hash of everything that determines the trained model: training
+        records, features, seed, and the classifier / sklearn versions.
+        """
+        h = hashlib.sha1()
+        h.update(repr((self.version, sklearn.__version__, self.features, self.seed)).encode('utf8'))
+        h.update(np.ascontiguousarray(self.feature_array(recs)).tobytes())
+        for name in ['id', 'ic_n_samples', 'ic_crosstalk_mean']:
+            h.update(np.ascontiguousarray(recs[name], dtype=float).tobytes())
+        h.update(np.ascontiguousarray(recs['synapse'].astype(bool)).tobytes())
+        return h.hexdigest()
+
+    def save(self, filename):
+        """Save the trained model to *filename*.
+        """
+        state = {
+            'version': self.version,
+            'sklearn_version': sklearn.__version__,
+            'fingerprint': self.fingerprint,
+            'features': self.features,
+            'seed': self.seed,
+            'scaler': self.scaler,
+            'clf': self.clf,
+            'prob_threshold': self.prob_threshold,
+        }
+        path = os.path.dirname(filename)
+        if path != '' and not os.path.isdir(path):
+            os.makedirs(path)
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_file, filename)
+
+    def load(self, filename, fingerprint=None):
+        """Load a trained model from *filename*.
+
+        If *fingerprint* is given, the model is only loaded if it was trained on
+        matching data. Return True if the model was loaded.
+        """
+        with open(filename, 'rb') as fh:
+            state = pickle.load(fh)
+        if state['version'] != self.version or state['sklearn_version'] != sklearn.__version__:
+            return False
+        if fingerprint is not None and state['fingerprint'] != fingerprint:
+            return False
+        self.fingerprint = state['fingerprint']
+        self.features = state['features']
+        self.seed = state['seed']
+        self.scaler = state['scaler']
+        self.clf = state['clf']
+        self.prob_threshold = state['prob_threshold']
+        return True
 
     def fit(self, recs):
         ids = recs['id']
 
         # Select features from records
-        features = np.array([tuple(r) for r in recs[self.features]])
+        features = self.feature_array(recs)
 
         # QC bad records; don't train on these
         mask = (recs['ic_n_samples'] > 100) & (recs['ic_crosstalk_mean'] < 60e-6)
@@ -1516,7 +2151,7 @@ class PairClassifier(object):
         # clf = sklearn.ensemble.RandomForestClassifier()
 
         hyper_params = [{'C': [1, 10, 100, 1000], 'gamma': [0.1, 0.01, 0.001, 0.0001]}]
-        clf = sklearn.model_selection.GridSearchCV(clf, hyper_params)
+        clf = sklearn.model_selection.GridSearchCV(clf, hyper_params, n_jobs=self.n_jobs)
         self.clf = clf
 
         clf.fit(train_x, train_y)
@@ -1550,10 +2185,7 @@ class PairClassifier(object):
         Input may be a structured array or list of dicts.
         """
         # Select features from records
-        if isinstance(recs, np.ndarray):
-            features = np.array([tuple(r) for r in recs[self.features]])
-        else:
-            features = np.array([tuple(map(r.__getitem__, self.features)) for r in recs])
+        features = self.feature_array(recs)
 
         # prepare ouptut array
         result = np.empty(len(features), dtype=[('prediction', float), ('confidence', float)])
@@ -1573,24 +2205,36 @@ class PairClassifier(object):
         assert np.isfinite(result[mask]['confidence']).sum() > 0
         return result
 
+    def feature_array(self, recs):
+        """Return a 2D float array of shape (len(recs), len(self.features)).
+
+        Input may be a structured array or list of dicts. Features are collected one
+        column at a time rather than one record at a time.
+        """
+        if isinstance(recs, np.ndarray):
+            columns = [np.asarray(recs[name], dtype=float) for name in self.features]
+        else:
+            columns = [np.array([r[name] for r in recs], dtype=float) for name in self.features]
+        if len(columns) == 0:
+            return np.empty((len(recs), 0))
+        return np.column_stack(columns)
+
 
 def join_struct_arrays(arrays):
     """Join two structured arrays together.
 
-    This is the most inefficient possible approach, but other methods
-    don't work well with object dtypes.
+    Data are copied one field at a time (numpy.lib.recfunctions does not work
+    well with object dtypes).
     """
     dtype = []
     for arr in arrays:
         for name in arr.dtype.names:
             dtype.append((str(name), arr.dtype.fields[name][0].str))
-    arr = np.empty(len(arrays[0]), dtype=dtype)
-    for i in range(len(arr)):
-        v = ()
-        for a in arrays:
-            v = v + tuple(a[i])
-        arr[i] = v
-    return arr
+    joined = np.empty(len(arrays[0]), dtype=dtype)
+    for arr in arrays:
+        for name in arr.dtype.names:
+            joined[str(name)] = arr[name]
+    return joined
 
 
 class PairScatterPlot(pg.QtCore.QObject):
@@ -1754,6 +2398,15 @@ def str_analysis_result_table(results, recs):
     """Convert output of strength_analysis.analyze_response_strength to look like
     the result was queried from the DB using get_amps() or get_baseline()
     """
+    columns = {k: [result[k] for result in results] for k in strength_keys}
+    return strength_result_table(columns, recs)
+
+
+def strength_result_table(results, recs, data=None):
+    """Like str_analysis_result_table, but *results* is a dict of arrays as returned
+    by analyze_response_strength_batch. If *data* is given, it is used in place of the
+    data stored in *recs*.
+    """
     dtype = [
         ('id', int),
         ('pos_amp', float),
@@ -1773,76 +2426,109 @@ def str_analysis_result_table(results, recs):
         ('rec_start_time', float),
     ]
     
-    table = np.empty(len(recs), dtype=dtype)
-    for i,rec in enumerate(recs):
-        for key in ['ex_qc_pass', 'in_qc_pass', 'clamp_mode', 'data']:
-            table[i][key] = getattr(rec, key)
-        result = results[i]
-        for key,val in result.items():
-            if key in table.dtype.names:
-                table[i][key] = val
-        table[i]['max_dvdt_time'] = 10e-3
-        table[i]['response_start_time'] = 0
+    table = np.zeros(len(recs), dtype=dtype)
+    for key in ['ex_qc_pass', 'in_qc_pass', 'clamp_mode']:
+        table[key] = [getattr(rec, key) for rec in recs]
+    if data is None:
+        data = [rec.data for rec in recs]
+    # assign element-wise so that equal-length arrays are not broadcast into a 2D array
+    for i, d in enumerate(data):
+        table['data'][i] = d
+    for key in strength_keys:
+        table[key] = results[key]
+    table['max_dvdt_time'] = 10e-3
+    table['response_start_time'] = 0
     return table
 
 
-class RecordWrapper(object):
-    """Wraps records returned from DB so that we can override some values.
-    """
-    def __init__(self, rec):
-        self._rec = rec
-    def __getattr__(self, attr):
-        return getattr(self._rec, attr)
-        
+def simulate_strength_trials(fg_recs, amp, rtime, n_trials=8, seed=0, lpf=True, bsub=True, lowpass=1000):
+    """Add synthetic PSPs to the data in *fg_recs* (usually background records) for
+    *n_trials* independent trials, and measure the strength of each simulated response.
 
-def simulate_response(fg_recs, bg_results, amp, rtime, seed=None):
-    if seed is not None:
-        np.random.seed(seed)
+    All trials and records are simulated and analyzed together as one array per snippet
+    length (see analyze_response_strength_batch). Trial *i* draws PSP amplitudes and
+    latencies from np.random.RandomState(seed + i) (or an unseeded RandomState if *seed*
+    is None).
 
-    dt = 1.0 / db.default_sample_rate
+    Returns (results, r_amps, data), where *results* is a dict of (n_trials, n_recs)
+    arrays for each of *strength_keys*, *r_amps* is the (n_trials, n_recs) array of
+    PSP amplitudes, and data[j] is an (n_trials, n_samples) array of simulated traces
+    for record j.
+    """
+    n = len(fg_recs)
+    sample_rate = db.default_sample_rate
+    dt = 1.0 / sample_rate
     t = np.arange(0, 15e-3, dt)
     template = Psp.psp_func(t, xoffset=0, yoffset=0, rise_time=rtime, decay_tau=15e-3, amp=1, rise_power=2)
 
-    r_amps = scipy.stats.binom.rvs(p=0.2, n=24, size=len(fg_recs)) * scipy.stats.norm.rvs(scale=0.3, loc=1, size=len(fg_recs))
-    r_amps *= amp / r_amps.mean()
-    r_latency = np.random.normal(size=len(fg_recs), scale=200e-6, loc=13e-3)
-    fg_results = []
-    traces = []
-    fg_recs = [RecordWrapper(rec) for rec in fg_recs]  # can't modify fg_recs, so we wrap records with a mutable shell
-    for k,rec in enumerate(fg_recs):
-        rec.data = rec.data.copy()
-        start = int(r_latency[k] * db.default_sample_rate)
-        length = len(rec.data) - start
-        rec.data[start:] += template[:length] * r_amps[k]
+    r_amps = np.empty((n_trials, n))
+    r_latency = np.empty((n_trials, n))
+    for i in range(n_trials):
+        rng = np.random.RandomState(None if seed is None else seed + i)
+        r_amps[i] = scipy.stats.binom.rvs(p=0.2, n=24, size=n, random_state=rng) * scipy.stats.norm.rvs(scale=0.3, loc=1, size=n, random_state=rng)
+        r_amps[i] *= amp / r_amps[i].mean()
+        r_latency[i] = rng.normal(size=n, scale=200e-6, loc=13e-3)
+    start = (r_latency * sample_rate).astype(int)
+
+    results = {k: np.empty((n_trials, n)) for k in strength_keys}
+    data = [None] * n
+    tau = np.array([15e-3 if rec.clamp_mode == 'ic' else 5e-3 for rec in fg_recs])
+    lengths = np.array([len(rec.data) for rec in fg_recs])
+    for length in np.unique(lengths):
+        rows = np.argwhere(lengths == length)[:, 0]
+        base = np.vstack([fg_recs[j].data for j in rows])
+
+        # inject the PSP template into every (trial, record) at its own latency
+        idx = np.arange(length)[None, None, :] - start[:, rows, None]
+        psp = np.where((idx >= 0) & (idx < len(template)), template[np.clip(idx, 0, len(template) - 1)], 0)
+        block = (base[None, :, :] + psp * r_amps[:, rows, None]).astype(base.dtype)
+
+        n_rows = n_trials * len(rows)
+        strength = _strength_block(block.reshape(n_rows, length), np.full(n_rows, 10e-3), np.full(n_rows, 11e-3),
+                                   np.tile(tau[rows], n_trials), lpf=lpf, bsub=bsub, lowpass=lowpass)
+        for k in strength_keys:
+            results[k][:, rows] = strength[k].reshape(n_trials, len(rows))
+        for i, j in enumerate(rows):
+            data[j] = block[:, i]
+
+    return results, r_amps, data
 
-        fg_result = analyze_response_strength(rec, 'baseline')
-        fg_results.append(fg_result)
 
-        traces.append(Trace(rec.data, sample_rate=db.default_sample_rate))
-        traces[-1].amp = r_amps[k]
-    fg_results = str_analysis_result_table(fg_results, fg_recs)
-    conn_result = analyze_pair_connectivity({('ic', 'fg'): fg_results, ('ic', 'bg'): bg_results, ('vc', 'fg'): [], ('vc', 'bg'): []}, sign=1)
-    return conn_result, traces
+def simulate_response(fg_recs, bg_results, amp, rtime, seed=None):
+    """Run a single simulation trial (see simulate_connection).
+    """
+    conn_results, traces = _simulate_trials(fg_recs, bg_results, amp, rtime, n_trials=1, seed=seed)
+    return conn_results[0], traces
+
+
+def _simulate_trials(fg_recs, bg_results, amp, rtime, n_trials, seed):
+    results, r_amps, data = simulate_strength_trials(fg_recs, amp, rtime, n_trials=n_trials, seed=seed)
+    conn_results = []
+    for i in range(n_trials):
+        fg_results = strength_result_table({k: results[k][i] for k in strength_keys}, fg_recs, data=[d[i] for d in data])
+        # simulated trials whose average fails to fit are classified without the fit features;
+        # fits of random simulated data are never reused, so they bypass the fit cache
+        conn_result = analyze_pair_connectivity({('ic', 'fg'): fg_results, ('ic', 'bg'): bg_results, ('vc', 'fg'): [], ('vc', 'bg'): []},
+                                                sign=1, fit_errors={}, use_cache=False)
+        conn_results.append(conn_result)
+
+    # traces from the last trial
+    traces = []
+    for j, d in enumerate(data):
+        traces.append(Trace(d[-1], sample_rate=db.default_sample_rate))
+        traces[-1].amp = r_amps[-1, j]
+    return conn_results, traces
 
 
-def simulate_connection(fg_recs, bg_results, classifier, amp, rtime, n_trials=8):
+def simulate_connection(fg_recs, bg_results, classifier, amp, rtime, n_trials=8, seed=0):
     """Run repeated simulation trials adding a synthetic PSP to recorded background noise.
+
+    Strength analysis for all trials is done in one batch (see simulate_strength_trials);
+    connectivity analysis (including the PSP fit to the average response) is then run
+    once per trial.
     """
-    import pyqtgraph.multiprocess as mp
     result = {'results': [], 'rise_time': rtime, 'amp': amp}
-
-    sim_results = [None] * n_trials
-    with mp.Parallelize(range(n_trials), results=sim_results, workers=8) as tasker:
-        for ii in tasker:
-            tasker.results[ii] = simulate_response(fg_recs, bg_results, amp, rtime, seed=ii)
-
-    for k in range(len(sim_results)):
-        conn_result, traces = sim_results[k]
-
-        result['results'].append(conn_result)
-        result['traces'] = traces
-        # print(conn_result)
-        # print(dict([(k, conn_result[k]) for k in classifier.features]))
+    result['results'], result['traces'] = _simulate_trials(fg_recs, bg_results, amp, rtime, n_trials=n_trials, seed=seed)
 
     pred = classifier.predict(result['results'])
     result['predictions'] = pred['prediction']
@@ -1853,43 +2539,66 @@ def simulate_connection(fg_recs, bg_results, classifier, amp, rtime, n_trials=8)
     return result
 
 
-
 if __name__ == '__main__':
     import user
 
     #tt = pg.debug.ThreadTrace()
     parser = argparse.ArgumentParser()
     parser.add_argument('--rebuild', action='store_true', default=False)
+    parser.add_argument('--update', action='store_true', default=False, help="Compute strength and connectivity only for new or out-of-date records")
+    parser.add_argument('--resume', action='store_true', default=False, help="Resume an interrupted strength rebuild")
     parser.add_argument('--rebuild-connectivity', action='store_true', default=False, dest='rebuild_connectivity')
     parser.add_argument('--local', action='store_true', default=False)
     parser.add_argument('--workers', type=int, default=6)
+    parser.add_argument('--headless', action='store_true', default=False, help="Run the requested rebuild without the debug console or UI, then exit")
+    parser.add_argument('--check-batch', action='store_true', default=False, dest='check_batch', help="Compare batch and per-record strength analysis, then exit")
     parser.add_argument('--seed', type=int, default=-1, help="Random seed used to shuffle classifier training data")
     
     args, extra = parser.parse_known_args(sys.argv[1:])
 
 
-    from multipatch_analysis.ui.multipatch_nwb_viewer import MultipatchNwbViewer    
-    from multipatch_analysis.experiment_list import cached_experiments
-    expts = cached_experiments()
+    if not args.headless:
+        from multipatch_analysis.ui.multipatch_nwb_viewer import MultipatchNwbViewer    
+        from multipatch_analysis.experiment_list import cached_experiments
+        expts = cached_experiments()
+
+        pg.dbg()
 
-    pg.dbg()
+    # skip confirmation prompts when running unattended
+    confirm = (lambda msg: True) if args.headless else (lambda msg: raw_input(msg) == 'y')
 
-    if args.rebuild and raw_input("Rebuild strength tables? ") == 'y':
+    if args.check_batch:
+        check_strength_batch()
+        sys.exit(0)
+
+    if args.rebuild and confirm("Rebuild strength tables? "):
         connection_strength_tables.drop_tables()
         pulse_response_strength_tables.drop_tables()
         init_tables()
         rebuild_strength(parallel=(not args.local), workers=args.workers)
-        rebuild_connectivity()
-    elif args.rebuild_connectivity and raw_input("Rebuild connectivity table? ") == 'y':
+        rebuild_connectivity(parallel=(not args.local), workers=args.workers)
+    elif args.update:
+        init_tables()
+        update_strength(parallel=(not args.local), workers=args.workers)
+    elif args.resume:
+        init_tables()
+        rebuild_strength(parallel=(not args.local), workers=args.workers)
+        connection_strength_tables.drop_tables()
+        init_tables()
+        rebuild_connectivity(parallel=(not args.local), workers=args.workers)
+    elif args.rebuild_connectivity and confirm("Rebuild connectivity table? "):
         print("drop tables..")
         connection_strength_tables.drop_tables()
         print("create tables..")
         init_tables()
         print("rebuild..")
-        rebuild_connectivity()
+        rebuild_connectivity(parallel=(not args.local), workers=args.workers)
     else:
         init_tables()
 
+    if args.headless:
+        sys.exit(0)
+
 
     # Load records on all pairs and train a classifier to predict connections
     classifier = get_pair_classifier(seed=None if args.seed < 0 else args.seed)
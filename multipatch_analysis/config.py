@@ -17,6 +17,19 @@ rig_name = None
 n_headstages = 8
 raw_data_paths = []
 summary_files = []
+# precision used to store floating point arrays in the DB: 'float64' (lossless), or the
+# lossy, more compact 'float32' or 'int16'
+array_storage = "float64"
+# optional compression for arrays stored in the DB: None, 'zstd' (requires zstandard), or 'blosc'
+array_compression = None
+array_compression_level = 3
+# if set, trace arrays for newly imported experiments are written to files in this directory
+# rather than stored in the DB (see database/trace_store.py)
+trace_store_path = None
+# if set, PSP fit results are cached in this directory (see fit_cache.py), up to
+# fit_cache_max_size bytes
+fit_cache_path = None
+fit_cache_max_size = 1e9
 
 
 template = """
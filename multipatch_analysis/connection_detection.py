@@ -1,10 +1,13 @@
+import inspect, multiprocessing, traceback
 from copy import deepcopy
+from collections import OrderedDict
 import numpy as np
 import scipy.signal
 import pyqtgraph as pg
 
 from .data import MultiPatchProbe, Analyzer, PulseStimAnalyzer
 from . import qc
+from .fit_cache import get_fit_cache, make_key
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.fitting import StackedPsp, Psp
@@ -40,6 +43,81 @@ class BaselineDistributor(Analyzer):
                 self.baselines.pop(0)
 
 
+class ResponseBlock(object):
+    """Pulse-response windows for one presynaptic recording, extracted from all
+    postsynaptic recordings of a sweep in a single operation.
+
+    Attributes
+    ----------
+    pre_rec : Recording
+        The presynaptic recording.
+    post_recs : list
+        The postsynaptic recordings (all other recordings in the sweep).
+    pulses : list
+        Window information for each pulse, as returned by MultiPatchSyncRecAnalyzer.response_windows().
+    starts, lengths : array
+        Start index and length of each response window. Windows are truncated early
+        when another pulse follows, so lengths may differ.
+    responses : array
+        Shape (len(post_recs), len(pulses), max(lengths)); postsynaptic primary data
+        for every window. Samples past the end of each window are NaN.
+    pre_primary, pre_command : array
+        Shape (len(pulses), max(lengths)); presynaptic primary and command data.
+    ex_qc_pass, in_qc_pass : array
+        Boolean arrays of shape (len(post_recs), len(pulses)) giving the result of
+        qc.pulse_response_qc_pass for each response.
+    """
+    def __init__(self, pre_rec, post_recs, pulses, post_data, pre_data, pre_command):
+        self.pre_rec = pre_rec
+        self.post_recs = post_recs
+        self.pulses = pulses
+        self.starts = np.array([p['rec_start'] for p in pulses], dtype=int)
+        stops = np.array([p['rec_stop'] for p in pulses], dtype=int)
+        n_samples = post_data.shape[-1]
+        self.lengths = np.clip(stops, 0, n_samples) - self.starts
+        assert np.all(self.lengths > 0)
+        for p in pulses:
+            assert len(range(n_samples)[p['baseline_start']:p['baseline_stop']]) > 0
+
+        # one fancy-indexing operation per array extracts all windows
+        width = self.lengths.max() if len(pulses) > 0 else 0
+        idx = self.starts[:, None] + np.arange(width)[None, :]
+        self._valid = idx < (self.starts + self.lengths)[:, None]
+        idx = np.clip(idx, 0, n_samples - 1)
+        self.responses = np.where(self._valid[None, :, :], post_data[:, idx], np.nan)
+        self.pre_primary = np.where(self._valid, pre_data[idx], np.nan)
+        self.pre_command = np.where(self._valid, pre_command[idx], np.nan)
+
+        windows = [[p['rec_start'], p['rec_stop']] for p in pulses]
+        n_spikes = [p['n_spikes'] for p in pulses]
+        adjacent = [p['adjacent_pulses'] for p in pulses]
+        self.ex_qc_pass = np.zeros((len(post_recs), len(pulses)), dtype=bool)
+        self.in_qc_pass = np.zeros((len(post_recs), len(pulses)), dtype=bool)
+        for i, post_rec in enumerate(post_recs):
+            if len(pulses) == 0:
+                break
+            qc_pass = np.array(qc.pulse_response_qc_pass_batch(post_rec, windows, n_spikes, adjacent), dtype=bool)
+            self.ex_qc_pass[i] = qc_pass[:, 0]
+            self.in_qc_pass[i] = qc_pass[:, 1]
+
+    def response(self, post_index, pulse_index):
+        """Return the postsynaptic data for one response window (without padding).
+        """
+        return self.responses[post_index, pulse_index, :self.lengths[pulse_index]]
+
+
+def _stack_traces(arrays):
+    """Stack 1D arrays into a 2D float array, padding shorter arrays with NaN.
+    """
+    n = max([len(a) for a in arrays])
+    dtype = np.result_type(*([a.dtype for a in arrays] + [np.float32]))
+    out = np.empty((len(arrays), n), dtype=dtype)
+    out[:] = np.nan
+    for i, a in enumerate(arrays):
+        out[i, :len(a)] = a
+    return out
+
+
 class MultiPatchSyncRecAnalyzer(Analyzer):
     """Used for analyzing two or more synchronous patch clamp recordings where
     spikes are evoked in at least one and synaptic responses are recorded in
@@ -48,14 +126,22 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
     def __init__(self, srec):
         self._attach(srec)
         self.srec = srec
+        self._windows = {}
 
-    def get_spike_responses(self, pre_rec, post_rec, align_to='pulse', pre_pad=10e-3, require_spike=True):
-        """Given a pre- and a postsynaptic recording, return a structure
-        containing evoked responses.
-        
-            [{pulse_n, pulse_ind, spike, response, baseline}, ...]
-        
+    def response_windows(self, pre_rec, dt, align_to='pulse', pre_pad=10e-3, require_spike=True):
+        """Return a list describing the response window for each presynaptic pulse in *pre_rec*:
+
+            [{pulse_n, pulse_ind, pulse_len, spike, rec_start, rec_stop, baseline_start,
+              baseline_stop, n_spikes, adjacent_pulses}, ...]
+
+        Indices are in samples of a recording with sample interval *dt* (all recordings
+        in a sweep share the same timebase, so the windows apply to every postsynaptic
+        recording). Returns None if *pre_rec* is not a MultiPatchProbe. Results are cached.
         """
+        key = (pre_rec.device_id, dt, align_to, pre_pad, require_spike)
+        if key in self._windows:
+            return self._windows[key]
+
         # detect presynaptic spikes
         pulse_stim = PulseStimAnalyzer.get(pre_rec)
         spikes = pulse_stim.evoked_spikes()
@@ -65,12 +151,10 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
             # Ideally we can make this agnostic to the exact stim type in the future,
             # but for now we rely on the delay period between pulses 8 and 9 to get
             # a baseline measurement.
-            return []
+            self._windows[key] = None
+            return None
 
-        dt = post_rec['primary'].dt
-        
-        # Select ranges to extract from postsynaptic recording
-        result = []
+        windows = []
         for i,pulse in enumerate(spikes):
             pulse = pulse.copy()
             spike = pulse['spike']
@@ -97,39 +181,90 @@ class MultiPatchSyncRecAnalyzer(Analyzer):
             else:
                 # otherwise, stop 50 ms later
                 pulse['rec_stop'] = max_stop
-            
-            # Extract data from postsynaptic recording
-            pulse['response'] = post_rec['primary'][pulse['rec_start']:pulse['rec_stop']]
-            assert len(pulse['response']) > 0
-
-            # Extract presynaptic spike and stimulus command
-            pulse['pre_rec'] = pre_rec['primary'][pulse['rec_start']:pulse['rec_stop']]
-            pulse['command'] = pre_rec['command'][pulse['rec_start']:pulse['rec_stop']]
 
             # select baseline region between 8th and 9th pulses
             baseline_dur = int(100e-3 / dt)
             stop = spikes[8]['pulse_ind']
-            start = stop - baseline_dur
-            pulse['baseline'] = post_rec['primary'][start:stop]
-            pulse['baseline_start'] = start
+            pulse['baseline_start'] = stop - baseline_dur
             pulse['baseline_stop'] = stop
 
-            # Add minimal QC metrics for excitatory and inhibitory measurements
-            pulse_window = [pulse['rec_start'], pulse['rec_stop']]
-            n_spikes = 0 if spike is None else 1  # eventually should check for multiple spikes
+            # information needed for minimal QC of excitatory and inhibitory measurements
+            pulse['n_spikes'] = 0 if spike is None else 1  # eventually should check for multiple spikes
             adj_pulse_times = []
             if prev_pulse is not None:
                 adj_pulse_times.append((prev_pulse - this_pulse) * dt)
             if next_pulse is not None:
                 adj_pulse_times.append((next_pulse - this_pulse) * dt)
-            pulse['ex_qc_pass'], pulse['in_qc_pass'] = qc.pulse_response_qc_pass(post_rec=post_rec, window=pulse_window, n_spikes=n_spikes, adjacent_pulses=adj_pulse_times)
+            pulse['adjacent_pulses'] = adj_pulse_times
+
+            windows.append(pulse)
+
+        self._windows[key] = windows
+        return windows
+
+    def get_spike_responses(self, pre_rec, post_rec, align_to='pulse', pre_pad=10e-3, require_spike=True):
+        """Given a pre- and a postsynaptic recording, return a structure
+        containing evoked responses.
+        
+            [{pulse_n, pulse_ind, spike, response, baseline}, ...]
+        
+        """
+        dt = post_rec['primary'].dt
+        windows = self.response_windows(pre_rec, dt, align_to=align_to, pre_pad=pre_pad, require_spike=require_spike)
+        if windows is None:
+            return []
+
+        # Select ranges to extract from postsynaptic recording
+        result = []
+        for window in windows:
+            pulse = window.copy()
+            
+            # Extract data from postsynaptic recording
+            pulse['response'] = post_rec['primary'][pulse['rec_start']:pulse['rec_stop']]
+            assert len(pulse['response']) > 0
+
+            # Extract presynaptic spike and stimulus command
+            pulse['pre_rec'] = pre_rec['primary'][pulse['rec_start']:pulse['rec_stop']]
+            pulse['command'] = pre_rec['command'][pulse['rec_start']:pulse['rec_stop']]
 
+            # select baseline region between 8th and 9th pulses
+            pulse['baseline'] = post_rec['primary'][pulse['baseline_start']:pulse['baseline_stop']]
             assert len(pulse['baseline']) > 0
 
             result.append(pulse)
+
+        # QC all pulse responses together so that window statistics are computed in one pass
+        if len(result) > 0:
+            qc_pass = qc.pulse_response_qc_pass_batch(post_rec=post_rec, windows=[[p['rec_start'], p['rec_stop']] for p in result],
+                n_spikes=[p['n_spikes'] for p in result], adjacent_pulses=[p['adjacent_pulses'] for p in result])
+            for pulse, (ex_qc_pass, in_qc_pass) in zip(result, qc_pass):
+                pulse['ex_qc_pass'] = ex_qc_pass
+                pulse['in_qc_pass'] = in_qc_pass
         
         return result
 
+    def get_response_blocks(self, align_to='pulse', pre_pad=10e-3, require_spike=True):
+        """Extract the responses to every presynaptic pulse from every postsynaptic
+        recording in the sweep at once.
+
+        Returns an OrderedDict {pre_dev: ResponseBlock} with one entry for each
+        device whose recording is a MultiPatchProbe. See ResponseBlock.
+        """
+        devices = list(self.srec.devices)
+        recs = [self.srec[dev] for dev in devices]
+        primary = _stack_traces([rec['primary'].data for rec in recs])
+        dt = recs[0]['primary'].dt
+
+        blocks = OrderedDict()
+        for i, pre_rec in enumerate(recs):
+            windows = self.response_windows(pre_rec, dt, align_to=align_to, pre_pad=pre_pad, require_spike=require_spike)
+            if windows is None:
+                continue
+            post_inds = [j for j in range(len(recs)) if j != i]
+            blocks[devices[i]] = ResponseBlock(pre_rec, [recs[j] for j in post_inds], windows,
+                                               primary[post_inds], primary[i], _stack_traces([pre_rec['command'].data])[0])
+        return blocks
+
     def get_pulse_response(self, pre_rec, post_rec, first_pulse=0, last_pulse=-1):
         pulse_stim = PulseStimAnalyzer.get(pre_rec)
         spikes = pulse_stim.evoked_spikes()
@@ -207,10 +342,12 @@ class MultiPatchExperimentAnalyzer(Analyzer):
         correct for multiple comparisons?
     Additional metric to detect low release probability connections?
     """
-    def __init__(self, expt):
+    def __init__(self, expt, max_cached_pairs=16):
         self._attach(expt)
         self.expt = expt
-        self._all_spikes = None
+        self.max_cached_pairs = max_cached_pairs
+        self._pair_index = None
+        self._pair_cache = OrderedDict()
 
     def get_evoked_responses(self, pre_id, post_id, clamp_mode='ic', stim_filter=None, min_duration=None, pulse_ids=None):
         """Return all evoked responses from device pre_id to post_id with the given
@@ -221,12 +358,8 @@ class MultiPatchExperimentAnalyzer(Analyzer):
         
         Returns a list of (response, baseline) pairs. 
         """
-        all_spikes = self._all_evoked_responses()
         responses = EvokedResponseGroup(pre_id, post_id)
-        if pre_id not in all_spikes or post_id not in all_spikes[pre_id]:
-            return responses
-        
-        for rec in all_spikes[pre_id][post_id]:
+        for rec in self._pair_responses(pre_id, post_id):
             
             # do filtering here:
             pre_rec = rec['pre_rec']
@@ -255,6 +388,7 @@ class MultiPatchExperimentAnalyzer(Analyzer):
         """Returned evoked responses for all pre/post pairs
         """
         devs = self.list_devs()
+        index = self._get_pair_index()
 
         all_responses = {}
         rows = set()
@@ -263,6 +397,9 @@ class MultiPatchExperimentAnalyzer(Analyzer):
             for j, dev2 in enumerate(devs):
                 if dev1 == dev2:
                     continue
+                if dev2 not in index[dev1]:
+                    all_responses[(dev1, dev2)] = EvokedResponseGroup(dev1, dev2)
+                    continue
                 resp = self.get_evoked_responses(dev1, dev2, **kwds)
                 if len(resp) > 0:
                     rows.add(dev1)
@@ -273,37 +410,65 @@ class MultiPatchExperimentAnalyzer(Analyzer):
 
         return all_responses, rows, cols
 
-    def _all_evoked_responses(self):
-        
+    def _get_pair_index(self):
+        """Return {pre_id: {post_id: [(srec, pre_rec, post_rec), ...]}} listing the
+        sweeps in which each pair of devices was recorded (without reading any data).
+        """
         # loop over all sweeps (presynaptic)
-        if self._all_spikes is None:
-            all_spikes = {}
+        if self._pair_index is None:
+            index = OrderedDict()
             for srec in self.expt.contents:
-                mp_analyzer = MultiPatchSyncRecAnalyzer.get(srec)
-                
                 for pre_rec in srec.recordings:
                     if not isinstance(pre_rec, MultiPatchProbe):
                         continue
                     pre_id = pre_rec.device_id
-                    all_spikes.setdefault(pre_id, {})
+                    index.setdefault(pre_id, OrderedDict())
                     # todo: ignore sweeps with high induction frequency
-                    
+
                     for post_rec in srec.recordings:
                         if post_rec is pre_rec:
                             continue
-                        post_id = post_rec.device_id
-                        all_spikes[pre_id].setdefault(post_id, [])
-                        spikes = {
-                            'spikes': mp_analyzer.get_spike_responses(pre_rec, post_rec),
-                            'pre_rec': pre_rec,
-                            'post_rec': post_rec,
-                        }
-                        all_spikes[pre_id][post_id].append(spikes)
-            self._all_spikes = all_spikes
-        return self._all_spikes
+                        index[pre_id].setdefault(post_rec.device_id, []).append((srec, pre_rec, post_rec))
+            self._pair_index = index
+        return self._pair_index
+
+    def _pair_responses(self, pre_id, post_id):
+        """Return a list of {'spikes', 'pre_rec', 'post_rec'} dicts, one for each
+        sweep in which *pre_id* and *post_id* were recorded together.
+
+        Only the sweeps containing the pair are analyzed. Results for the most recently
+        used *max_cached_pairs* pairs are kept.
+        """
+        key = (pre_id, post_id)
+        if key in self._pair_cache:
+            result = self._pair_cache.pop(key)
+        else:
+            result = []
+            for srec, pre_rec, post_rec in self._get_pair_index().get(pre_id, {}).get(post_id, []):
+                mp_analyzer = MultiPatchSyncRecAnalyzer.get(srec)
+                result.append({
+                    'spikes': mp_analyzer.get_spike_responses(pre_rec, post_rec),
+                    'pre_rec': pre_rec,
+                    'post_rec': post_rec,
+                })
+        self._pair_cache[key] = result
+        while len(self._pair_cache) > self.max_cached_pairs:
+            self._pair_cache.popitem(last=False)
+        return result
+
+    def _all_evoked_responses(self):
+        """Return {pre_id: {post_id: [...]}} with the results of _pair_responses for
+        all pairs. This analyzes every sweep; prefer get_evoked_responses for single pairs.
+        """
+        all_spikes = {}
+        for pre_id, posts in self._get_pair_index().items():
+            all_spikes[pre_id] = {}
+            for post_id in posts:
+                all_spikes[pre_id][post_id] = self._pair_responses(pre_id, post_id)
+        return all_spikes
 
     def list_devs(self):
-        return self._all_evoked_responses().keys()
+        return list(self._get_pair_index().keys())
 
 
 
@@ -498,7 +663,226 @@ class EvokedResponseGroup(object):
         response = self.bsub_mean()
         if response is None:
             return None
-        return fit_psp(response, **kwds)
+        return cached_fit_psp(response, **kwds)
+
+
+class EvokedResponseArray(object):
+    """Array-backed alternative to EvokedResponseGroup.
+
+    Responses and baselines are accumulated into running per-sample sums, sums of
+    squares, and counts, so that mean() and bsub_mean() do not need to revisit every
+    trace. Raw response data is kept in a growable NaN-padded 2D buffer only if
+    *keep_traces* is True (or until release() is called).
+
+    Differences from EvokedResponseGroup:
+
+    * All responses are aligned at their first sample (as bsub_mean does in
+      EvokedResponseGroup); mean() therefore also ignores t0.
+    * Responses or baselines whose sample rate differs from the first response are
+      resampled to that rate (rather than downsampling everything to the lowest rate).
+    * Baselines may be None.
+    """
+    def __init__(self, pre_id=None, post_id=None, keep_traces=True, **kwds):
+        self.pre_id = pre_id
+        self.post_id = post_id
+        self.kwds = kwds
+        self.keep_traces = keep_traces
+        self._sample_rate = None
+        self._resp_sum = _RunningSum()
+        self._base_sum = _RunningSum()
+        self._resp_buffer = _TraceBuffer() if keep_traces else None
+        self._base_buffer = _TraceBuffer() if keep_traces else None
+        self._t0 = []
+        self.spikes = []
+        self.commands = []
+        self._bsub_mean = None
+
+    def add(self, response, baseline, pre_spike=None, stim_command=None):
+        if self._sample_rate is None:
+            self._sample_rate = response.sample_rate
+        response = self._conform(response)
+        baseline = None if baseline is None else self._conform(baseline)
+
+        self._resp_sum.add(response.data)
+        if baseline is not None:
+            self._base_sum.add(baseline.data)
+        if self.keep_traces:
+            self._resp_buffer.append(response.data)
+            self._base_buffer.append(None if baseline is None else baseline.data)
+            self._t0.append((response.t0, None if baseline is None else baseline.t0))
+            self.spikes.append(pre_spike)
+            self.commands.append(stim_command)
+        self._bsub_mean = None
+
+    def _conform(self, trace):
+        if trace.sample_rate != self._sample_rate:
+            trace = trace.resample(sample_rate=self._sample_rate)
+        return trace
+
+    def __len__(self):
+        return self._resp_sum.n
+
+    @property
+    def responses(self):
+        """List of response Traces (only available if keep_traces is True).
+        """
+        self._check_traces_kept()
+        return [self._make_trace(self._resp_buffer[i], self._t0[i][0]) for i in range(len(self._resp_buffer))]
+
+    @property
+    def baselines(self):
+        """List of baseline Traces (only available if keep_traces is True).
+        """
+        self._check_traces_kept()
+        return [self._make_trace(self._base_buffer[i], self._t0[i][1]) for i in range(len(self._base_buffer))]
+
+    def _check_traces_kept(self):
+        if self._resp_buffer is None:
+            raise RuntimeError("Individual traces were not kept for this EvokedResponseArray "
+                               "(created with keep_traces=False, or release() was called).")
+
+    def _make_trace(self, data, t0):
+        if data is None:
+            return None
+        return Trace(data, sample_rate=self._sample_rate, t0=t0)
+
+    def release(self):
+        """Discard raw traces, keeping only the running statistics.
+        """
+        self.keep_traces = False
+        self._resp_buffer = None
+        self._base_buffer = None
+        self._t0 = []
+        self.spikes = []
+        self.commands = []
+
+    def mean(self):
+        """Return the average response trace.
+        """
+        if len(self) == 0:
+            return None
+        avg = Trace(self._resp_sum.mean(), sample_rate=self._sample_rate, t0=0)
+        avg.meta['mean_of_n'] = len(self)
+        return avg
+
+    def std(self):
+        """Return the per-sample standard deviation of all responses as a trace.
+        """
+        if len(self) == 0:
+            return None
+        return Trace(self._resp_sum.std(), sample_rate=self._sample_rate, t0=0)
+
+    def bsub_mean(self):
+        """Return a baseline-subtracted, average evoked response trace (see EvokedResponseGroup.bsub_mean).
+        """
+        if len(self) == 0:
+            return None
+
+        if self._bsub_mean is None:
+            avg = self._resp_sum.mean()
+            if self._base_sum.n == 0:
+                avg_baseline = np.empty(0)
+                baseline = 0
+            else:
+                avg_baseline = self._base_sum.mean()
+                baseline = np.median(avg_baseline)
+
+            result = Trace(avg - baseline, sample_rate=self._sample_rate, t0=0)
+            result.meta['baseline'] = avg_baseline
+            result.meta['baseline_med'] = baseline
+            if len(avg_baseline) == 0:
+                result.meta['baseline_std'] = None
+            else:
+                result.meta['baseline_std'] = scipy.signal.detrend(avg_baseline).std()
+
+            self._bsub_mean = result
+
+        return self._bsub_mean
+
+    def fit_psp(self, **kwds):
+        response = self.bsub_mean()
+        if response is None:
+            return None
+        return cached_fit_psp(response, **kwds)
+
+
+class _RunningSum(object):
+    """Per-sample running sum, sum of squares, and count of non-NaN values for a
+    set of 1D arrays that are aligned at their first sample.
+    """
+    def __init__(self):
+        self.n = 0
+        self.min_len = None
+        self.sum = np.zeros(0)
+        self.sumsq = np.zeros(0)
+        self.count = np.zeros(0, dtype=int)
+
+    def add(self, data):
+        n = len(data)
+        if n > len(self.sum):
+            pad = n - len(self.sum)
+            self.sum = np.concatenate([self.sum, np.zeros(pad)])
+            self.sumsq = np.concatenate([self.sumsq, np.zeros(pad)])
+            self.count = np.concatenate([self.count, np.zeros(pad, dtype=int)])
+        valid = np.isfinite(data)
+        data = np.where(valid, data, 0)
+        self.sum[:n] += data
+        self.sumsq[:n] += data**2
+        self.count[:n] += valid
+        self.n += 1
+        self.min_len = n if self.min_len is None else min(self.min_len, n)
+
+    def mean(self):
+        """Mean of all arrays, clipped to the length of the shortest array.
+        """
+        n = self.min_len or 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum[:n] / self.count[:n]
+
+    def std(self):
+        n = self.min_len or 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum[:n] / self.count[:n]
+            return np.sqrt(np.clip(self.sumsq[:n] / self.count[:n] - mean**2, 0, None))
+
+
+class _TraceBuffer(object):
+    """Growable, NaN-padded 2D buffer of 1D arrays (one per row), with a length per row.
+    None entries are allowed.
+    """
+    def __init__(self, capacity=16):
+        self._data = None
+        self._lengths = np.zeros(capacity, dtype=int)
+        self._missing = np.zeros(capacity, dtype=bool)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def append(self, data):
+        if self._n == len(self._lengths):
+            # double the row capacity
+            self._lengths = np.concatenate([self._lengths, np.zeros(len(self._lengths), dtype=int)])
+            self._missing = np.concatenate([self._missing, np.zeros(len(self._missing), dtype=bool)])
+            if self._data is not None:
+                self._data = np.concatenate([self._data, np.full(self._data.shape, np.nan, dtype=self._data.dtype)])
+        if data is None:
+            self._missing[self._n] = True
+        else:
+            n = len(data)
+            if self._data is None:
+                self._data = np.full((len(self._lengths), n), np.nan, dtype=np.result_type(data.dtype, np.float32))
+            elif n > self._data.shape[1]:
+                pad = np.full((self._data.shape[0], n - self._data.shape[1]), np.nan, dtype=self._data.dtype)
+                self._data = np.concatenate([self._data, pad], axis=1)
+            self._data[self._n, :n] = data
+            self._lengths[self._n] = n
+        self._n += 1
+
+    def __getitem__(self, i):
+        if self._missing[i]:
+            return None
+        return self._data[i, :self._lengths[i]]
 
 
 def fit_psp(response, mode='ic', sign='any', xoffset=(11e-3, 10e-3, 15e-3), yoffset=(0, 'fixed'),
@@ -615,27 +999,196 @@ def fit_psp(response, mode='ic', sign='any', xoffset=(11e-3, 10e-3, 15e-3), yoff
     return fit
 
 
+class PspFitResult(object):
+    """Picklable summary of a PSP fit returned by fit_psp_batch.
+
+    Provides the attributes of the lmfit ModelResult returned by fit_psp that
+    are used by analyses (best_values, init_values, best_fit, residual, snr, err,
+    rmse(), nrmse()), but not the model itself.
+    """
+    def __init__(self, fit):
+        self.best_values = dict(fit.best_values)
+        self.init_values = dict(fit.init_values)
+        self.best_fit = fit.best_fit
+        self.residual = fit.residual
+        self.success = fit.success
+        self.nfev = fit.nfev
+        self.chisqr = fit.chisqr
+        self.snr = getattr(fit, 'snr', None)
+        self.err = getattr(fit, 'err', None)
+        self._rmse = fit.rmse()
+        self._nrmse = fit.nrmse()
+
+    def rmse(self):
+        return self._rmse
+
+    def nrmse(self):
+        return self._nrmse
+
+
+# increment when changes to fit_psp affect its results (invalidates cached fits)
+psp_fit_version = 1
+
+
+def psp_fit_key(response, **kwds):
+    """Return the fit cache key (see fit_cache.make_key) for ``fit_psp(response, **kwds)``.
+
+    The key depends on the response data, dt, t0, and baseline_std, and on all
+    fit_psp arguments (with defaults filled in, so omitted and explicitly given
+    default arguments give the same key).
+    """
+    params = _fit_psp_defaults()
+    params.update(kwds)
+    return make_key('fit_psp', psp_fit_version, response.data, response.dt, response.t0,
+                    response.meta.get('baseline_std', None), params)
+
+
+def _fit_psp_defaults():
+    try:
+        spec = inspect.getfullargspec(fit_psp)
+    except AttributeError:
+        spec = inspect.getargspec(fit_psp)
+    return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+
+
+def cached_fit_psp(response, **kwds):
+    """Return ``fit_psp(response, **kwds)`` as a PspFitResult.
+
+    If a fit cache is configured (config.fit_cache_path), results are read from /
+    stored in the cache.
+    """
+    cache = get_fit_cache()
+    if cache is None:
+        return PspFitResult(fit_psp(response, **kwds))
+    key = psp_fit_key(response, **kwds)
+    fit = cache.get(key)
+    if fit is None:
+        fit = PspFitResult(fit_psp(response, **kwds))
+        cache.set(key, fit)
+    return fit
+
+
+def fit_psp_batch(responses, workers=None, **kwds):
+    """Fit many average responses with fit_psp.
+
+    Each sign candidate of each response (two per response when sign='any') is
+    fit as a separate task in a pool of *workers* processes (default is one per
+    core; workers=1 fits serially in this process). For every response, the
+    candidate with the smallest residual is selected exactly as fit_psp does, so
+    results are identical to calling fit_psp(response, **kwds) on each response.
+
+    *responses* is a list of Traces (None entries are allowed). Return a list of
+    PspFitResult, with None for responses that are None or could not be fit. Other
+    errors in a worker are raised here as RuntimeError, including the worker's traceback.
+    Results are read from / stored in the fit cache if one is configured.
+    """
+    cache = get_fit_cache()
+    fits = [None] * len(responses)
+    keys = [None] * len(responses)
+    if cache is not None:
+        for i, response in enumerate(responses):
+            if response is None:
+                continue
+            keys[i] = psp_fit_key(response, **kwds)
+            fits[i] = cache.get(keys[i])
+
+    kwds = kwds.copy()
+    sign = kwds.pop('sign', 'any')
+    if sign == 'any':
+        signs = ['+', '-']
+    elif sign in ('+', '-'):
+        signs = [sign]
+    else:
+        raise ValueError('sign must be "+", "-", or "any"')
+    if kwds.get('mode', 'ic') not in ('ic', 'vc'):
+        raise ValueError('mode must be "ic" or "vc"')
+
+    # traces are passed to workers as plain arrays
+    tasks = []
+    for i, response in enumerate(responses):
+        if response is None or fits[i] is not None:
+            continue
+        trace = (response.data, response.dt, response.t0, response.meta.get('baseline_std', None))
+        for s in signs:
+            kw = kwds.copy()
+            kw['sign'] = s
+            tasks.append((i, trace, kw))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(_fit_psp_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_fit_psp_task(task) for task in tasks]
+
+    # errors other than fit failures are re-raised here with the worker's traceback
+    for fit, error in results:
+        if error is not None:
+            raise RuntimeError("Error fitting PSP in worker process:\n%s" % error)
+
+    # select the best candidate for each response; like fit_psp, a response fails
+    # if its last candidate fails
+    scores = [None] * len(responses)
+    for (i, trace, kw), (fit, error) in zip(tasks, results):
+        if fit is None:
+            if kw['sign'] == signs[-1]:
+                fits[i] = None
+                scores[i] = np.inf
+            continue
+        err = np.sum(fit.residual**2)
+        if scores[i] is None or err < scores[i]:
+            fits[i] = fit
+            scores[i] = err
+
+    if cache is not None:
+        for i in set([task[0] for task in tasks]):
+            if fits[i] is not None:
+                cache.set(keys[i], fits[i])
+    return fits
+
+
+def _fit_psp_task(task):
+    # Return (fit, error). Fits that fail to converge (the optimizer raising
+    # ValueError / LinAlgError or an arithmetic error) give fit=None; any other
+    # exception is returned as a formatted traceback so that the parent process
+    # can report it instead of treating it as a failed fit.
+    try:
+        i, (data, dt, t0, baseline_std), kwds = task
+        response = Trace(data, dt=dt, t0=t0)
+        if baseline_std is not None:
+            response.meta['baseline_std'] = baseline_std
+        try:
+            fit = fit_psp(response, **kwds)
+        except (ValueError, ArithmeticError):
+            return None, None
+        return PspFitResult(fit), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
 def detect_connections(expt):
     analyzer = MultiPatchExperimentAnalyzer.get(expt)
 
     # First get average evoked responses for all pre/post pairs with long decay time
     all_responses, rows, cols = analyzer.get_evoked_response_matrix(clamp_mode='ic', min_duration=16e-3)
 
-    for pre_id in rows:
-        for post_id in cols:
-            try:
-                response = all_responses[(pre_id, post_id)]
-                if len(response) == 0:
-                    continue
-            except KeyError:
-                continue
+    pairs = [(pre_id, post_id) for pre_id in rows for post_id in cols if len(all_responses.get((pre_id, post_id), ())) > 0]
 
-            # fit average to extract PSP decay
-            fit = response.fit_psp(yoffset=0)
+    # fit averages to extract PSP decay
+    fits = fit_psp_batch([all_responses[pair].bsub_mean() for pair in pairs], yoffset=0)
+
+    for (pre_id, post_id), fit in zip(pairs, fits):
+        if fit is None:
+            continue
 
-            # make connectivity call
-            lsnr = np.log(fit.snr)
-            lnrmse = np.log(fit.nrmse())
-            if lsnr > lnrmse + 6:
-                print "Connection:", pre_id, post_id, fit.snr, fit.nrmse()
+        # make connectivity call
+        lsnr = np.log(fit.snr)
+        lnrmse = np.log(fit.nrmse())
+        if lsnr > lnrmse + 6:
+            print "Connection:", pre_id, post_id, fit.snr, fit.nrmse()
 
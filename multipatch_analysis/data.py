@@ -30,6 +30,44 @@ class MultiPatchSyncRecording(MiesSyncRecording):
         else:
             return miesrec
 
+    def load_data(self, channels=('primary', 'command')):
+        """Read the data for all recordings in this sweep from the NWB file.
+
+        Data is otherwise read on first access; calling this ahead of time allows
+        reading to be done in a background thread (see util.prefetch). Channels
+        that a recording does not have are skipped.
+        """
+        for rec in self.recordings:
+            rec_channels = rec.channels
+            for ch in channels:
+                if ch not in rec_channels:
+                    continue
+                try:
+                    rec[ch].data
+                except Exception:
+                    # (eg. command data can't be generated without a holding value)
+                    # leave the error to be raised if the data is actually used
+                    pass
+
+    def release_data(self):
+        """Discard data read from the NWB file and the analyzers attached to this
+        sweep and its recordings, so that their memory can be reclaimed once the
+        sweep has been processed. Data is read again if it is accessed later.
+        """
+        objs = [self]
+        for rec in self.recordings:
+            objs.append(rec)
+            if isinstance(rec, MultiPatchProbe):
+                objs.append(rec._parent_rec)
+            for ch in rec.channels:
+                trace = rec[ch]
+                if getattr(trace, '_data', None) is not None:
+                    trace._data = None
+        for obj in objs:
+            for attr, val in list(vars(obj).items()):
+                if isinstance(val, Analyzer):
+                    delattr(obj, attr)
+
     def baseline_regions(self, settling_time=100e-3):
         """Return a list of start,stop pairs indicating regions during the recording that are expected to be quiescent
         due to absence of pulses.
@@ -149,3 +187,41 @@ class PulseStimAnalyzer(Analyzer):
         rec_delay = np.round(dt*np.diff(pulses).max(), 3)
         
         return ind_freq, rec_delay
+
+
+class ResampleAnalyzer(Analyzer):
+    """Resamples the channels of a recording once and serves snippets of the
+    resampled data by index arithmetic, rather than resampling each snippet
+    separately.
+    """
+    def __init__(self, rec):
+        self._attach(rec)
+        self.rec = rec
+        self._resampled = {}
+
+    def resampled(self, sample_rate, channel='primary'):
+        """Return the data of *channel* resampled to *sample_rate* (cached).
+        """
+        key = (channel, sample_rate)
+        if key not in self._resampled:
+            trace = self.rec[channel]
+            if trace.sample_rate != sample_rate:
+                trace = trace.resample(sample_rate=sample_rate)
+            self._resampled[key] = trace.data
+        return self._resampled[key]
+
+    def snippet(self, start, stop, sample_rate, channel='primary'):
+        """Return data equivalent to ``rec[channel][start:stop].resample(sample_rate).data``.
+
+        *start* and *stop* are indices into the original (native rate) data. If the
+        native rate differs from *sample_rate*, the snippet is taken from the resampled
+        recording and may differ from resampling the snippet alone near its edges.
+        """
+        trace = self.rec[channel]
+        if trace.sample_rate == sample_rate:
+            return trace.data[start:stop]
+        start, stop, _ = slice(start, stop).indices(len(trace.data))
+        ratio = sample_rate / float(trace.sample_rate)
+        i1 = int(np.round(start * ratio))
+        n = int(np.round(max(0, stop - start) * ratio))
+        return self.resampled(sample_rate, channel)[i1:i1+n]
@@ -0,0 +1,260 @@
+"""
+Binary encoding for numpy arrays stored in DB columns.
+
+Arrays are stored with a small fixed header followed by the payload::
+
+    magic (4 bytes)  version (uint8)  payload (uint8)  dtype (4 bytes)  ndim (uint8)
+    compression (uint8)  filters (uint8)  padding (3 bytes)
+    shape (ndim * uint64)
+    scale (float64)
+    payload data
+
+Floating point arrays may be stored at reduced precision (float32, or int16
+with a per-array scale factor). Uncompressed payloads are decoded using
+np.frombuffer, so float32 and full-precision arrays are returned without
+copying (the returned arrays are read-only).
+
+Payloads may optionally be passed through delta and byte-shuffle filters and
+compressed with zstd or blosc. The compression used is recorded in each blob, so
+compressed and uncompressed blobs can be mixed freely within a column.
+
+Alternatively, the payload may be written to an external file (see trace_store),
+in which case the blob holds only the header and the (path, offset, size) of
+the payload.
+
+Blobs written by older versions with np.save are recognized and decoded with
+np.load.
+"""
+import io, struct
+import numpy as np
+
+
+MAGIC = b'\x00NDA'
+VERSION = 2
+
+# payload encodings
+RAW = 0       # array stored with its own dtype
+FLOAT32 = 1   # floating-point array stored as float32
+INT16 = 2     # floating-point array stored as int16; multiply by scale to decode
+
+storage_modes = {'float64': RAW, 'float32': FLOAT32, 'int16': INT16}
+
+# compression codecs
+NONE = 0
+ZSTD = 1
+BLOSC = 2
+
+compression_modes = {None: NONE, 'zstd': ZSTD, 'blosc': BLOSC}
+
+# payload is stored outside the blob; body contains offset, size, and file path
+EXTERNAL = 3
+
+# filter flags
+DELTA = 1     # store differences between consecutive values (integer payloads only)
+SHUFFLE = 2   # group bytes by significance before compressing
+
+_header = struct.Struct('<4sBB4sBBB3x')
+_scale = struct.Struct('<d')
+_external = struct.Struct('<QQH')
+
+
+def encode_array(arr, storage='float64', compression=None, level=3):
+    """Encode *arr* as bytes.
+
+    Parameters
+    ----------
+    arr : ndarray
+        Array to encode.
+    storage : str
+        Precision used to store floating-point arrays: 'float64' (the default) stores
+        the array unmodified, 'float32' stores single-precision values, and 'int16'
+        stores 16-bit integers scaled to the range of the array. Non-float arrays are
+        always stored unmodified. Arrays with non-numeric dtypes are stored with
+        np.save.
+    compression : None, 'zstd', or 'blosc'
+        Compression codec applied to the payload (requires the zstandard or
+        blosc package, respectively).
+    level : int
+        Compression level.
+    """
+    arr = np.asarray(arr)
+    prepared = _prepare_payload(arr, storage)
+    if prepared is None:
+        buf = io.BytesIO()
+        np.save(buf, arr, allow_pickle=False)
+        return buf.getvalue()
+    payload, dtype_str, scale, data = prepared
+
+    codec = compression_modes[compression]
+    filters = 0
+    if codec == NONE:
+        body = data.tobytes()
+    else:
+        if data.dtype.kind in 'iu':
+            filters |= DELTA
+            data = _delta_encode(data)
+        if data.dtype.itemsize > 1:
+            filters |= SHUFFLE
+        body = _compress(data, codec, level, shuffle=bool(filters & SHUFFLE))
+
+    # blobs without compression can still be read by version 1 decoders
+    version = 1 if codec == NONE else VERSION
+    return _pack_header(version, payload, dtype_str, arr.shape, codec, filters, scale) + body
+
+
+def encode_external(arr, write, storage='float64'):
+    """Encode *arr* as a reference to a payload stored outside the DB.
+
+    *write* is called with the payload bytes and must return the (path, offset)
+    where they were stored. Arrays that can't be stored this way (non-numeric
+    dtypes) are encoded inline.
+    """
+    arr = np.asarray(arr)
+    prepared = _prepare_payload(arr, storage)
+    if prepared is None:
+        return encode_array(arr, storage=storage)
+    payload, dtype_str, scale, data = prepared
+
+    payload_bytes = data.tobytes()
+    path, offset = write(payload_bytes)
+    path = path.encode('utf8')
+    body = _external.pack(offset, len(payload_bytes), len(path)) + path
+    return _pack_header(VERSION, payload, dtype_str, arr.shape, EXTERNAL, 0, scale) + body
+
+
+def is_external(buf):
+    """Return True if *buf* was generated by encode_external.
+    """
+    if len(buf) < _header.size or bytes(buf[:4]) != MAGIC:
+        return False
+    return _header.unpack_from(buf, 0)[5] == EXTERNAL
+
+
+def decode_array(buf, read_external=None):
+    """Decode an array from bytes generated by encode_array, encode_external, or np.save.
+
+    For external payloads, *read_external(path, offset, size)* must return a
+    buffer containing the payload bytes.
+    """
+    if bytes(buf[:4]) != MAGIC:
+        return np.load(io.BytesIO(buf), allow_pickle=False)
+
+    magic, version, payload, dtype_str, ndim, codec, filters = _header.unpack_from(buf, 0)
+    if version > VERSION:
+        raise ValueError("Unsupported array encoding version %d" % version)
+    offset = _header.size
+    shape = struct.unpack_from('<%dQ' % ndim, buf, offset)
+    offset += 8 * ndim
+    scale = _scale.unpack_from(buf, offset)[0]
+    offset += _scale.size
+
+    if payload == RAW:
+        dtype = np.dtype(dtype_str.strip().decode('ascii'))
+    elif payload == FLOAT32:
+        dtype = np.dtype('<f4')
+    elif payload == INT16:
+        dtype = np.dtype('<i2')
+    else:
+        raise ValueError("Unknown array payload encoding %d" % payload)
+
+    count = int(np.prod(shape))
+    if codec == EXTERNAL:
+        if read_external is None:
+            raise ValueError("Array payload is stored externally, but no external reader was given")
+        ext_offset, size, path_len = _external.unpack_from(buf, offset)
+        offset += _external.size
+        path = bytes(buf[offset:offset+path_len]).decode('utf8')
+        buf = read_external(path, ext_offset, size)
+        offset = 0
+    elif codec != NONE:
+        buf = _decompress(buf[offset:], codec, dtype.itemsize, shuffle=bool(filters & SHUFFLE))
+        offset = 0
+    data = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    if filters & DELTA:
+        data = _delta_decode(data)
+    data = data.reshape(shape)
+
+    if payload == INT16:
+        return data * np.float32(scale)
+    return data
+
+
+def _prepare_payload(arr, storage):
+    """Return (payload, dtype_str, scale, data) for encoding *arr*, or None if the
+    array dtype is not supported.
+    """
+    dtype = arr.dtype
+    dtype_str = dtype.str if dtype.byteorder == '|' else dtype.newbyteorder('<').str
+    if dtype.kind not in 'biuf' or len(dtype_str) > 4:
+        return None
+
+    payload = storage_modes[storage] if dtype.kind == 'f' else RAW
+    scale = 1.0
+    if payload == INT16:
+        if not np.all(np.isfinite(arr)):
+            # can't represent nan/inf as scaled int
+            payload = FLOAT32
+        else:
+            amax = np.abs(arr).max() if arr.size > 0 else 0
+            scale = float(amax) / 32767. if amax > 0 else 1.0
+            data = np.round(arr / scale).astype('<i2')
+    if payload == FLOAT32:
+        data = arr.astype('<f4')
+    elif payload == RAW:
+        data = arr.astype(dtype_str)
+    return payload, dtype_str, scale, np.ascontiguousarray(data)
+
+
+def _pack_header(version, payload, dtype_str, shape, codec, filters, scale):
+    header = _header.pack(MAGIC, version, payload, dtype_str.encode('ascii').ljust(4), len(shape), codec, filters)
+    return header + struct.pack('<%dQ' % len(shape), *shape) + _scale.pack(scale)
+
+
+def _delta_encode(data):
+    flat = data.ravel()
+    delta = np.empty_like(flat)
+    if len(flat) > 0:
+        delta[0] = flat[0]
+        np.subtract(flat[1:], flat[:-1], out=delta[1:])
+    return delta
+
+
+def _delta_decode(delta):
+    # integer overflow wraps around identically in both directions, so this is exact
+    return np.cumsum(delta, dtype=delta.dtype)
+
+
+def _shuffle(data):
+    itemsize = data.dtype.itemsize
+    return data.view(np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(buf, itemsize):
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    return raw.reshape(itemsize, -1).T.tobytes()
+
+
+def _compress(data, codec, level, shuffle):
+    if codec == ZSTD:
+        import zstandard
+        body = _shuffle(data) if shuffle else data.tobytes()
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    elif codec == BLOSC:
+        import blosc
+        return blosc.compress(data.tobytes(), typesize=data.dtype.itemsize, clevel=min(level, 9),
+                              shuffle=blosc.SHUFFLE if shuffle else blosc.NOSHUFFLE, cname='zstd')
+    else:
+        raise ValueError("Unknown compression codec %d" % codec)
+
+
+def _decompress(buf, codec, itemsize, shuffle):
+    if codec == ZSTD:
+        import zstandard
+        body = zstandard.ZstdDecompressor().decompress(bytes(buf))
+        return _unshuffle(body, itemsize) if shuffle else body
+    elif codec == BLOSC:
+        # blosc records its own shuffle setting
+        import blosc
+        return blosc.decompress(bytes(buf))
+    else:
+        raise ValueError("Unknown compression codec %d" % codec)
@@ -0,0 +1,242 @@
+"""
+Bulk row insertion for the synphys DB.
+
+The ORM is convenient for building small record trees, but the unit-of-work
+overhead dominates when an experiment generates tens of thousands of rows.
+BulkInserter collects rows into per-table columnar buffers, assigns primary keys
+from the table sequences up front, and writes each table with a single
+PostgreSQL COPY (or executemany if the DB driver does not support COPY).
+"""
+from __future__ import print_function
+import io, json, math, binascii
+from collections import OrderedDict
+import numpy as np
+
+import sqlalchemy
+from sqlalchemy import Integer, Float, Boolean, Date, DateTime, LargeBinary
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import TypeDecorator
+
+from . import database as db
+
+
+class BulkRow(object):
+    """Stand-in for an ORM entry whose row will be written by BulkInserter.
+
+    Column names and many-to-one relationship names may be read or assigned
+    just as with the ORM class, up until the row is written. Relationship
+    values may be other BulkRows or ORM entries; they are resolved to foreign
+    key IDs at write time.
+    """
+    def __init__(self, buffer, index):
+        self.__dict__['_buffer'] = buffer
+        self.__dict__['_index'] = index
+
+    def __getattr__(self, attr):
+        buf = self.__dict__['_buffer']
+        col = buf.attr_columns.get(attr)
+        if col is None:
+            raise AttributeError(attr)
+        return buf.columns[col][self.__dict__['_index']]
+
+    def __setattr__(self, attr, value):
+        col = self._buffer.attr_columns.get(attr)
+        if col is None:
+            # ORM entries accept arbitrary (non-persisted) attributes as well
+            self.__dict__[attr] = value
+        else:
+            self._buffer.columns[col][self._index] = value
+
+    def __repr__(self):
+        return "<BulkRow %s[%d]>" % (self._buffer.table.name, self._index)
+
+
+class TableBuffer(object):
+    """Columnar buffer of rows to be inserted into a single table.
+    """
+    def __init__(self, orm_class):
+        self.orm_class = orm_class
+        self.table = orm_class.__table__
+        self.columns = OrderedDict([(col.name, []) for col in self.table.columns])
+
+        # map attribute names (columns and many-to-one relationships) to column names
+        self.attr_columns = {name: name for name in self.columns}
+        for rel in sqlalchemy.inspect(orm_class).relationships:
+            if rel.direction is not MANYTOONE or len(rel.local_columns) != 1:
+                continue
+            self.attr_columns[rel.key] = list(rel.local_columns)[0].name
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def append(self, **kwds):
+        index = len(self)
+        for col in self.columns.values():
+            col.append(None)
+        for k,v in kwds.items():
+            col = self.attr_columns.get(k)
+            if col is None:
+                raise TypeError("%r is an invalid keyword argument for %s" % (k, self.orm_class.__name__))
+            self.columns[col][index] = v
+        return BulkRow(self, index)
+
+
+class BulkInserter(object):
+    """Collects new rows for many tables and writes them all at once.
+
+    Rows are added with the same keyword arguments that would be given to the
+    ORM class constructor::
+
+        inserter = BulkInserter(session)
+        srec = inserter.add(db.SyncRec, experiment=expt_entry, ext_id=1)
+        rec = inserter.add(db.Recording, sync_rec=srec, ...)
+        inserter.flush()
+
+    All rows are written using the session's connection, so they become part of
+    the session's current transaction.
+    """
+    def __init__(self, session, use_copy=True):
+        self.session = session
+        self.use_copy = use_copy
+        self.buffers = OrderedDict()
+
+    def add(self, orm_class, **kwds):
+        buf = self.buffers.get(orm_class.__table__.name)
+        if buf is None:
+            buf = TableBuffer(orm_class)
+            self.buffers[orm_class.__table__.name] = buf
+        return buf.append(**kwds)
+
+    def flush(self):
+        """Write all buffered rows to the DB.
+        """
+        # make sure ORM entries referenced by buffered rows have IDs
+        self.session.flush()
+        conn = self.session.connection()
+
+        # assign IDs up front so that rows can reference each other
+        for buf in self.buffers.values():
+            buf.columns['id'] = self._reserve_ids(conn, buf.table, len(buf))
+
+        # write tables in dependency order
+        for table in db.ORMBase.metadata.sorted_tables:
+            buf = self.buffers.get(table.name)
+            if buf is None or len(buf) == 0:
+                continue
+            self._fill_defaults(conn, buf)
+            self._resolve_references(buf)
+            if not (self.use_copy and self._copy(conn, buf)):
+                self._executemany(conn, buf)
+
+        self.buffers = OrderedDict()
+
+    def _reserve_ids(self, conn, table, n):
+        seq = conn.execute(sqlalchemy.text("select pg_get_serial_sequence(:table, 'id')"), table=table.name).scalar()
+        ids = conn.execute(sqlalchemy.text("select nextval(:seq) from generate_series(1, :n)"), seq=seq, n=n)
+        return [row[0] for row in ids]
+
+    def _fill_defaults(self, conn, buf):
+        """Apply column insert defaults (eg. time_created) to rows that have no value.
+        """
+        for col in buf.table.columns:
+            default = col.default
+            if default is None or col.primary_key:
+                continue
+            if default.is_scalar:
+                value = default.arg
+            elif default.is_clause_element:
+                value = conn.execute(sqlalchemy.select([default.arg])).scalar()
+            else:
+                continue
+            vals = buf.columns[col.name]
+            for i,v in enumerate(vals):
+                if v is None:
+                    vals[i] = value
+
+    def _resolve_references(self, buf):
+        """Replace ORM entries / BulkRows in foreign key columns with their IDs.
+        """
+        for col in buf.table.columns:
+            if len(col.foreign_keys) == 0:
+                continue
+            vals = buf.columns[col.name]
+            for i,v in enumerate(vals):
+                if v is not None and not isinstance(v, (int, np.integer)):
+                    vals[i] = v.id
+
+    def _executemany(self, conn, buf):
+        names = list(buf.columns.keys())
+        rows = [dict(zip(names, vals)) for vals in zip(*buf.columns.values())]
+        conn.execute(buf.table.insert(), rows)
+
+    def _copy(self, conn, buf):
+        """Write rows using COPY FROM STDIN. Return False if the DB driver does not support COPY.
+        """
+        cursor = conn.connection.cursor()
+        if not hasattr(cursor, 'copy_expert'):
+            return False
+
+        dialect = conn.dialect
+        names = list(buf.columns.keys())
+        formatters = [_copy_formatter(col, dialect) for col in buf.table.columns]
+        lines = []
+        for vals in zip(*buf.columns.values()):
+            lines.append('\t'.join([fmt(v) for fmt,v in zip(formatters, vals)]))
+        data = io.BytesIO(('\n'.join(lines) + '\n').encode('utf8'))
+
+        sql = "COPY %s (%s) FROM STDIN" % (buf.table.name, ', '.join(['"%s"' % n for n in names]))
+        cursor.copy_expert(sql, data)
+        return True
+
+
+def _copy_escape(text):
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_float(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return repr(value)
+
+
+def _copy_bytea(value):
+    return '\\\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+
+
+def _copy_formatter(column, dialect):
+    """Return a function that converts python values to COPY text format for *column*.
+    """
+    coltype = column.type
+    process = None
+    if isinstance(coltype, TypeDecorator):
+        process = coltype.process_bind_param
+        coltype = coltype.impl
+        if isinstance(coltype, type):
+            coltype = coltype()
+
+    if isinstance(coltype, JSONB):
+        fmt = lambda v: _copy_escape(json.dumps(v))
+    elif isinstance(coltype, LargeBinary):
+        fmt = _copy_bytea
+    elif isinstance(coltype, Boolean):
+        fmt = lambda v: 't' if v else 'f'
+    elif isinstance(coltype, Integer):
+        fmt = lambda v: str(int(v))
+    elif isinstance(coltype, Float):
+        fmt = _copy_float
+    elif isinstance(coltype, (Date, DateTime)):
+        fmt = lambda v: v.isoformat()
+    else:
+        fmt = lambda v: _copy_escape(v if isinstance(v, type(u'')) else str(v))
+
+    def format_value(v):
+        if process is not None:
+            v = process(v, dialect)
+        if v is None:
+            return '\\N'
+        return fmt(v)
+    return format_value
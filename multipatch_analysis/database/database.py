@@ -18,6 +18,8 @@ from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql.expression import func
 
 from .. import config
+from .array_codec import encode_array, decode_array
+from .trace_store import ExternalArray, get_trace_store
 
 default_sample_rate = 20000
 
@@ -199,6 +201,15 @@ table_schemas = {
         ('in_qc_pass', 'bool', 'Indicates whether this recording snippet passes QC for inhibitory synapse probing'),
         ('baseline_id', 'baseline.id'),
     ],
+    'import_ledger': [
+        "Records the source files and outcome of each experiment import, so that imports can be resumed and repeated incrementally",
+        ('expt_uid', 'str', 'Unique ID (acquisition timestamp) of the imported experiment', {'index': True, 'unique': True}),
+        ('status', 'str', '"started", "complete", or "failed"'),
+        ('importer_version', 'int', 'Version of the import code (ExperimentDBSubmission.version) used for the last import'),
+        ('content_hash', 'str', 'SHA1 hash combining the hashes of all source files'),
+        ('source_files', 'object', 'Dict describing each source file: {name: {path, size, mtime, sha1}}'),
+        ('error', 'str', 'Error message from the last failed import'),
+    ],
 }
 
 
@@ -210,21 +221,42 @@ ORMBase = declarative_base()
 
 class NDArray(TypeDecorator):
     """For marshalling arrays in/out of binary DB fields.
+
+    Arrays are encoded with array_codec; floating point data is stored with the
+    precision given by *storage* and compressed with *compression* (defaults are
+    config.array_storage and config.array_compression).
+
+    Values may also be ExternalArray instances (see trace_store), in which case
+    the array data lives outside the DB and only a reference is stored. These
+    are decoded as read-only views of a memory-mapped file.
     """
     impl = LargeBinary
+
+    def __init__(self, storage=None, compression=None, *args, **kwds):
+        TypeDecorator.__init__(self, *args, **kwds)
+        self.storage = storage
+        self.compression = compression
     
     def process_bind_param(self, value, dialect):
         if value is None:
             return b'' 
-        buf = io.BytesIO()
-        np.save(buf, value, allow_pickle=False)
-        return buf.getvalue()
+        if isinstance(value, ExternalArray):
+            return value.blob
+        return encode_array(value, storage=self.storage or config.array_storage,
+                            compression=self.compression or config.array_compression,
+                            level=config.array_compression_level)
         
     def process_result_value(self, value, dialect):
-        if value == b'':
+        if value is None or len(value) == 0:
             return None
-        buf = io.BytesIO(value)
-        return np.load(buf, allow_pickle=False)
+        return decode_array(value, read_external=read_external_array)
+
+
+def read_external_array(path, offset, size):
+    store = get_trace_store()
+    if store is None:
+        raise RuntimeError("Array data is stored in an external trace store, but config.trace_store_path is not set.")
+    return store.read(path, offset, size)
 
 
 class FloatType(TypeDecorator):
@@ -305,7 +337,7 @@ def _generate_mapping(table, base=None):
 
 def create_all_mappings():
     global Slice, Experiment, Electrode, Cell, Pair, SyncRec, Recording, PatchClampRecording, MultiPatchProbe
-    global TestPulse, StimPulse, StimSpike, PulseResponse, Baseline
+    global TestPulse, StimPulse, StimSpike, PulseResponse, Baseline, ImportLedger
 
     # Generate ORM mapping classes
 
@@ -378,6 +410,7 @@ def create_all_mappings():
     StimSpike = _generate_mapping('stim_spike')
     PulseResponse = _generate_mapping('pulse_response')
     Baseline = _generate_mapping('baseline')
+    ImportLedger = _generate_mapping('import_ledger')
 
     # Set up relationships
     Slice.experiments = relationship("Experiment", order_by=Experiment.id, back_populates="slice")
@@ -533,3 +566,41 @@ def experiment_from_timestamp(ts, session=None):
 
 
 
+
+
+def delete_experiment(expt_id, session):
+    """Delete an experiment and all rows that depend on it, including rows in
+    analysis tables that are not mapped in this module.
+
+    The deletion happens within the transaction of *session*; the caller is
+    responsible for committing.
+    """
+    conn = session.connection()
+    meta = sqlalchemy.MetaData()
+    meta.reflect(bind=conn)
+
+    # for each table, build a query selecting the IDs of rows that belong to the experiment
+    owned = {}
+    for table in meta.sorted_tables:
+        if 'id' not in table.c:
+            continue
+        if table.name == 'experiment':
+            owned[table.name] = sqlalchemy.select([table.c.id]).where(table.c.id == expt_id)
+            continue
+        conds = [fk.parent.in_(owned[fk.column.table.name]) for fk in table.foreign_keys
+                 if fk.column.table.name in owned and fk.column.table is not table]
+        if len(conds) > 0:
+            owned[table.name] = sqlalchemy.select([table.c.id]).where(or_(*conds))
+
+    # test pulses are referenced by (rather than referencing) the recordings they belong to
+    pcr = meta.tables['patch_clamp_recording']
+    tp_ids = conn.execute(sqlalchemy.select([pcr.c.nearest_test_pulse_id]).where(
+        pcr.c.id.in_(owned['patch_clamp_recording']))).fetchall()
+    tp_ids = [r[0] for r in tp_ids if r[0] is not None]
+
+    # delete children before parents
+    for table in reversed(meta.sorted_tables):
+        if table.name in owned:
+            conn.execute(table.delete().where(table.c.id.in_(owned[table.name])))
+        elif table.name == 'test_pulse' and len(tp_ids) > 0:
+            conn.execute(table.delete().where(table.c.id.in_(tp_ids)))
@@ -0,0 +1,207 @@
+"""
+Ledger of experiment imports.
+
+Each import is recorded in the import_ledger table along with a hash of the
+experiment's source files (NWB, pipettes.yml, site mosaic) and the version of
+the import code. This lets import_to_database run incrementally:
+
+* experiments whose source files and importer version are unchanged are skipped
+* experiments whose source files changed since they were imported are deleted
+  from the DB and imported again
+* imports that were interrupted (left in the "started" state) are redone
+* the reason for skipping each experiment is reported
+"""
+from __future__ import print_function
+import os, hashlib, traceback
+from collections import OrderedDict
+
+from . import database as db
+from .submission import SliceSubmission, ExperimentDBSubmission
+from .trace_store import get_trace_store
+
+
+def create_ledger_table():
+    """Create the import_ledger table if it does not exist (for DBs created
+    before the ledger was added).
+    """
+    db.ImportLedger.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def source_files(expt):
+    """Return an ordered dict of {name: path} for the files that an experiment
+    is imported from. Missing files have path None.
+    """
+    files = OrderedDict()
+    files['nwb'] = expt.nwb_file
+    files['pipettes'] = os.path.join(expt.path, 'pipettes.yml')
+    try:
+        files['mosaic'] = expt.mosaic_file
+    except Exception:
+        files['mosaic'] = None
+    return files
+
+
+def file_hash(filename, blocksize=2**24):
+    hash = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            hash.update(block)
+    return hash.hexdigest()
+
+
+def fingerprint(expt, previous=None):
+    """Return (files, content_hash) describing the source files of *expt*.
+
+    *previous* is the source_files dict recorded by an earlier import; files
+    whose path, size, and mtime have not changed since then are not hashed again.
+    """
+    previous = previous or {}
+    files = OrderedDict()
+    for name, path in source_files(expt).items():
+        if path is None or not os.path.isfile(path):
+            files[name] = None
+            continue
+        st = os.stat(path)
+        info = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime}
+        prev = previous.get(name)
+        if prev is not None and all([prev.get(k) == v for k,v in info.items()]):
+            info['sha1'] = prev['sha1']
+        else:
+            info['sha1'] = file_hash(path)
+        files[name] = info
+
+    content = hashlib.sha1()
+    for name, info in files.items():
+        content.update(('%s:%s\n' % (name, None if info is None else info['sha1'])).encode('utf8'))
+    return files, content.hexdigest()
+
+
+def changed_files(old, new):
+    """Return the names of source files that differ between two source_files dicts.
+    """
+    old = old or {}
+    sha = lambda info: None if info is None else info['sha1']
+    return [name for name in new if sha(old.get(name)) != sha(new[name])]
+
+
+@db.default_session
+def ledger_entry(expt_uid, session=None):
+    """Return the import_ledger entry for an experiment, or None.
+    """
+    return session.query(db.ImportLedger).filter(db.ImportLedger.expt_uid==expt_uid).first()
+
+
+def check_experiment(expt, session, retry_failed=False):
+    """Decide whether *expt* needs to be imported.
+
+    Return (action, reason, files, content_hash), where action is 'import',
+    'skip', or 'record' (the experiment was imported before the ledger existed
+    and only needs a ledger entry; since the version of the importer used is
+    unknown, it will be re-imported by a later run).
+    """
+    entry = ledger_entry(expt.uid, session=session)
+    in_db = ExperimentDBSubmission(expt).submitted()
+    files, content_hash = fingerprint(expt, None if entry is None else entry.source_files)
+
+    if entry is None:
+        if in_db:
+            return 'record', 'already in DB; added to ledger', files, content_hash
+        return 'import', 'new experiment', files, content_hash
+
+    if entry.status == 'started':
+        return 'import', 'previous import was interrupted', files, content_hash
+    if entry.content_hash != content_hash:
+        changed = changed_files(entry.source_files, files)
+        return 'import', 'source files changed: %s' % ', '.join(changed), files, content_hash
+    if entry.status == 'failed':
+        if retry_failed:
+            return 'import', 'retrying failed import', files, content_hash
+        error = (entry.error or '').strip().split('\n')[-1]
+        return 'skip', 'previous import failed: %s' % error, files, content_hash
+    if not in_db:
+        return 'import', 'missing from DB', files, content_hash
+    if entry.importer_version is None or entry.importer_version < ExperimentDBSubmission.version:
+        return 'import', 'imported with older importer version %s' % entry.importer_version, files, content_hash
+    return 'skip', 'unchanged since last import', files, content_hash
+
+
+def set_status(expt_uid, status, error=None, importer_version=None):
+    session = db.Session()
+    try:
+        entry = ledger_entry(expt_uid, session=session)
+        entry.status = status
+        entry.error = error
+        if importer_version is not None:
+            entry.importer_version = importer_version
+        session.commit()
+    finally:
+        session.close()
+
+
+def remove_experiment(expt):
+    """Delete a previous import of *expt* from the DB (and the trace store), if there is one.
+    """
+    session = db.Session()
+    try:
+        try:
+            expt_id = db.experiment_from_timestamp(expt.datetime, session=session).id
+        except KeyError:
+            return
+        db.delete_experiment(expt_id, session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    store = get_trace_store()
+    if store is not None:
+        store.remove(expt_id)
+
+
+def import_experiment(expt, retry_failed=False, **kwds):
+    """Import *expt* (and its slice) if it is new, has changed, or was not
+    completely imported previously.
+
+    Extra keyword arguments are passed to ExperimentDBSubmission.
+
+    Return (action, reason), where action is 'imported', 'recorded', or 'skipped'.
+    If the import fails, the error is recorded in the ledger and re-raised.
+    """
+    session = db.Session()
+    try:
+        action, reason, files, content_hash = check_experiment(expt, session, retry_failed=retry_failed)
+        if action == 'skip':
+            return 'skipped', reason
+
+        entry = ledger_entry(expt.uid, session=session)
+        if entry is None:
+            entry = db.ImportLedger(expt_uid=expt.uid)
+            session.add(entry)
+        entry.source_files = files
+        entry.content_hash = content_hash
+        # the importer version is only known once this code has imported the experiment;
+        # experiments found already in the DB may have been imported by an older version
+        entry.importer_version = None
+        entry.error = None
+        entry.status = 'complete' if action == 'record' else 'started'
+        session.commit()
+    finally:
+        session.close()
+
+    if action == 'record':
+        return 'recorded', reason
+
+    try:
+        sub = SliceSubmission(expt.slice_dir)
+        if not sub.submitted():
+            sub.submit()
+        remove_experiment(expt)
+        ExperimentDBSubmission(expt, **kwds).submit()
+    except Exception:
+        set_status(expt.uid, 'failed', error=traceback.format_exc())
+        raise
+
+    set_status(expt.uid, 'complete', importer_version=ExperimentDBSubmission.version)
+    return 'imported', reason
@@ -0,0 +1,285 @@
+"""
+Streaming reads of large query results from the synphys DB.
+
+Loading a query with Query.all() or pandas.read_sql builds every row as a Python
+object (and decodes every array column) before the first row can be used. For
+queries touching many pulse responses, stream_query instead reads rows through a
+server-side cursor (stream_results) and yields them as RecordBatch objects holding
+one numpy array per column. Array (NDArray) columns are fetched as raw blobs and
+only decoded when the column is first accessed on a batch, so memory use is bounded
+by the batch size rather than the size of the result set.
+
+    for batch in stream_query(q, batch_size=1000):
+        analyze(batch['data'], batch['clamp_mode'])
+"""
+from __future__ import print_function
+import numbers, datetime
+from collections import OrderedDict
+import numpy as np
+
+import sqlalchemy
+from sqlalchemy import LargeBinary
+
+from . import database as db
+from .array_codec import decode_array
+
+
+class RecordBatch(object):
+    """A batch of query rows stored as one numpy array per column.
+
+    Columns are accessed by name (``batch['pos_amp']``) or as attributes of
+    individual records (``batch.record(i).pos_amp``). Array columns are decoded
+    on first access.
+    """
+    def __init__(self, columns, array_columns=()):
+        self._names = list(columns.keys())
+        self._len = len(columns[self._names[0]]) if len(self._names) > 0 else 0
+        self._columns = columns
+        self._raw = OrderedDict([(name, columns.pop(name)) for name in array_columns])
+
+    def keys(self):
+        return list(self._names)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __getitem__(self, name):
+        if name in self._raw:
+            blobs = self._raw.pop(name)
+            self._columns[name] = _object_array([_decode(blob) for blob in blobs])
+        return self._columns[name]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def record(self, i):
+        """Return a record giving attribute access to row *i*.
+        """
+        return BatchRecord(self, i)
+
+    def to_records(self):
+        """Return the batch as a numpy structured array (decoding all array columns).
+        """
+        return _struct_array(OrderedDict([(name, self[name]) for name in self._names]))
+
+
+class BatchRecord(object):
+    """Attribute access to a single row of a RecordBatch.
+    """
+    __slots__ = ['_batch', '_index']
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    def __getattr__(self, attr):
+        try:
+            return self._batch[attr][self._index]
+        except KeyError:
+            raise AttributeError(attr)
+
+
+def stream_query(query, batch_size=1000):
+    """Execute *query* (a sqlalchemy Query) with a server-side cursor and yield a
+    RecordBatch for every *batch_size* rows.
+    """
+    cols = []
+    array_columns = []
+    for desc in query.column_descriptions:
+        expr = desc['expr']
+        if isinstance(getattr(expr, 'type', None), db.NDArray):
+            # fetch raw bytes; arrays are decoded when the batch column is accessed
+            expr = sqlalchemy.type_coerce(expr, LargeBinary).label(desc['name'])
+            array_columns.append(desc['name'])
+        cols.append(expr)
+    if len(array_columns) > 0:
+        query = query.with_entities(*cols)
+
+    conn = query.session.connection().execution_options(stream_results=True)
+    result = conn.execute(query.statement)
+    try:
+        names = list(result.keys())
+        while True:
+            rows = result.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            columns = OrderedDict()
+            for i, name in enumerate(names):
+                columns[name] = [row[i] for row in rows]
+            for name in names:
+                if name not in array_columns:
+                    columns[name] = column_array(columns[name])
+            yield RecordBatch(columns, array_columns=array_columns)
+    finally:
+        result.close()
+
+
+def query_records(query, batch_size=1000):
+    """Return all rows of *query* as a numpy structured array, similar to
+    ``pandas.read_sql_query(query.statement, ...).to_records()`` (without the index field),
+    but read in streamed batches.
+
+    Column dtypes are determined across all batches (see merge_records), so a column
+    does not change type depending on which rows happen to share a batch.
+    """
+    batches = [batch.to_records() for batch in stream_query(query, batch_size=batch_size)]
+    if len(batches) == 0:
+        names = [desc['name'] for desc in query.column_descriptions]
+        return np.empty(0, dtype=[(str(name), object) for name in names])
+    return merge_records(batches)
+
+
+def query_record_groups(query, group_by, batch_size=1000):
+    """Read *query* in streamed batches and split its rows into groups by the values
+    of the *group_by* columns.
+
+    Each batch is split as soon as it is read, so memory use is bounded by the size of
+    the result plus one batch (rather than the whole result set being loaded first, as
+    with pandas).
+
+    Return (groups, dtype), where groups is an OrderedDict {key: structured array} with
+    keys being tuples of the *group_by* values, and records (without the *group_by*
+    fields) in query order. *dtype* is the record dtype, for creating empty groups.
+    """
+    chunks = OrderedDict()
+    for batch in stream_query(query, batch_size=batch_size):
+        recs = batch.to_records()
+        keys = list(zip(*[recs[name].tolist() for name in group_by]))
+        rows = OrderedDict()
+        for i, key in enumerate(keys):
+            rows.setdefault(key, []).append(i)
+        for key, inds in rows.items():
+            chunks.setdefault(key, []).append(recs[inds])
+
+    all_chunks = [c for group in chunks.values() for c in group]
+    if len(all_chunks) == 0:
+        names = [desc['name'] for desc in query.column_descriptions]
+        dtype = np.dtype([(str(name), object) for name in names if name not in group_by])
+        return OrderedDict(), dtype
+
+    full_dtype = merged_dtype(all_chunks)
+    dtype = np.dtype([(name, full_dtype[name]) for name in full_dtype.names if name not in group_by])
+    groups = OrderedDict([(key, merge_records(group, dtype=dtype)) for key, group in chunks.items()])
+    return groups, dtype
+
+
+def merge_records(chunks, dtype=None):
+    """Concatenate structured arrays built from different query batches.
+
+    Each batch infers its column dtypes from the values it contains (see
+    column_array), so the same column may differ between batches (for example,
+    a nullable datetime column that is NULL for every row of one batch). The
+    dtype of each column is resolved once across all chunks (or given by *dtype*,
+    as returned by merged_dtype) before concatenating.
+    """
+    if dtype is None:
+        dtype = merged_dtype(chunks)
+    if len(chunks) == 0:
+        return np.empty(0, dtype=dtype)
+    columns = OrderedDict()
+    for name in dtype.names:
+        columns[name] = np.concatenate([_cast_column(c[name], dtype[name]) for c in chunks])
+    return _struct_array(columns)
+
+
+def merged_dtype(chunks):
+    """Return the structured dtype that merge_records would use for *chunks*.
+    """
+    names = chunks[0].dtype.names
+    return np.dtype([(name, _common_dtype([c[name] for c in chunks])) for name in names])
+
+
+def _all_null(arr):
+    # column_array gives all-NULL columns as float NaN (or object None)
+    if arr.dtype.kind == 'f':
+        return bool(np.all(np.isnan(arr)))
+    if arr.dtype.kind == 'O':
+        return all([v is None for v in arr])
+    return len(arr) == 0
+
+
+def _common_dtype(arrays):
+    typed = [a for a in arrays if not _all_null(a)]
+    has_null = len(typed) < len(arrays) or any([a.dtype.kind == 'f' and np.any(np.isnan(a)) for a in typed])
+    if len(typed) == 0:
+        return np.dtype(float)
+    kinds = set([a.dtype.kind for a in typed])
+    if kinds == set(['M']):
+        return np.dtype('datetime64[ns]')
+    if kinds == set(['b']):
+        # as with pandas, a bool column with NULLs is an object column
+        return np.dtype(object) if has_null else np.dtype(bool)
+    if kinds <= set(['i', 'u', 'f']):
+        dtype = np.result_type(*[a.dtype for a in typed])
+        return np.result_type(dtype, float) if has_null else dtype
+    return np.dtype(object)
+
+
+def _cast_column(arr, dtype):
+    if arr.dtype == dtype:
+        return arr
+    if _all_null(arr):
+        if dtype.kind == 'O':
+            return np.full(len(arr), None, dtype=object)
+        if dtype.kind == 'M':
+            return np.full(len(arr), np.datetime64('NaT'), dtype=dtype)
+        return np.full(len(arr), np.nan, dtype=dtype)
+    if dtype.kind == 'O':
+        if arr.dtype.kind == 'M':
+            # datetime64[ns].tolist() gives integers; go through microseconds for datetime objects
+            arr = arr.astype('datetime64[us]')
+        return _object_array(arr.tolist())
+    return arr.astype(dtype)
+
+
+def column_array(values):
+    """Convert a list of column values to a numpy array.
+
+    Numeric columns with missing values become float arrays with NaN, and
+    datetimes become datetime64 (as pandas.read_sql would do); other columns
+    become object arrays.
+    """
+    types = set([type(v) for v in values if v is not None])
+    has_null = any([v is None for v in values])
+    if len(types) == 0:
+        return np.full(len(values), np.nan)
+    if all([issubclass(t, (bool, np.bool_)) for t in types]):
+        return np.array(values, dtype=bool) if not has_null else _object_array(values)
+    if all([issubclass(t, numbers.Number) and not issubclass(t, (bool, np.bool_, complex)) for t in types]):
+        if has_null or any([issubclass(t, (float, np.floating)) for t in types]):
+            return np.array([np.nan if v is None else v for v in values], dtype=float)
+        return np.array(values)
+    if all([issubclass(t, datetime.datetime) for t in types]):
+        return np.array([None if v is None else _naive_utc(v) for v in values], dtype='datetime64[ns]')
+    return _object_array(values)
+
+
+def _naive_utc(dt):
+    if dt.tzinfo is None:
+        return dt
+    return (dt - dt.utcoffset()).replace(tzinfo=None)
+
+
+def _decode(blob):
+    if blob is None or len(blob) == 0:
+        return None
+    return decode_array(blob, read_external=db.read_external_array)
+
+
+def _object_array(values):
+    # assign element-wise so that sequences (e.g. equal-length arrays) are not broadcast
+    arr = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        arr[i] = v
+    return arr
+
+
+def _struct_array(columns):
+    arr = np.empty(len(next(iter(columns.values()))), dtype=[(str(name), col.dtype) for name, col in columns.items()])
+    for name, col in columns.items():
+        arr[str(name)] = col
+    return arr
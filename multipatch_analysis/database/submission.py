@@ -7,12 +7,15 @@ import pyqtgraph as pg
 from neuroanalysis.baseline import float_mode
 from neuroanalysis.data import PatchClampRecording
 from . import database as db
+from .bulk import BulkInserter
+from .trace_store import get_trace_store
 from .. import lims
-from ..data import MultiPatchExperiment, MultiPatchProbe
+from ..data import MultiPatchExperiment, MultiPatchProbe, ResampleAnalyzer
 from ..connection_detection import PulseStimAnalyzer, MultiPatchSyncRecAnalyzer, BaselineDistributor
 from .. import config
 from .. import constants
 from .. import qc
+from ..util import prefetch
 
 
 class SliceSubmission(object):
@@ -128,11 +131,32 @@ class ExperimentDBSubmission(object):
     
     This causes several tables to be populated: experiment, sync_rec, recording,
     stim_pulse, stim_spike, pulse_response, baseline
+
+    If *bulk* is True, then the (very numerous) rows generated from the NWB file
+    are collected and written with a single COPY per table rather than through
+    the ORM. The resulting rows are the same either way.
+
+    If a trace store is configured (config.trace_store_path), then stim_pulse,
+    pulse_response, and baseline data are written to the experiment's trace
+    store file and the DB holds only references to them.
+
+    If *prefetch* > 0, up to that many sweeps are read from the NWB file in
+    *prefetch_threads* background threads while earlier sweeps are being
+    analyzed.
     """
     message = "Generating database entries"
 
-    def __init__(self, expt):
+    # Increment this when changes to the import require existing experiments to
+    # be re-imported (see import_ledger)
+    #   2: stim pulse snippets, responses, and baselines are cut from recordings
+    #      resampled once per recording (ResampleAnalyzer)
+    version = 2
+
+    def __init__(self, expt, bulk=False, prefetch=0, prefetch_threads=2):
         self.expt = expt
+        self.bulk = bulk
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
         self._fields = None
 
     def submitted(self):
@@ -275,11 +299,49 @@ class ExperimentDBSubmission(object):
 
     def _load_nwb(self, session, expt_entry, elecs_by_ad_channel, pairs_by_device_id):
         nwb = self.expt.data
-        
-        for srec in nwb.contents:
+
+        if self.bulk:
+            inserter = BulkInserter(session)
+            new_entry = inserter.add
+        else:
+            def new_entry(orm_class, **kwds):
+                entry = orm_class(**kwds)
+                session.add(entry)
+                return entry
+
+        store = get_trace_store()
+        if store is None:
+            writer = None
+            store_array = lambda arr: arr
+        else:
+            # trace store file is selected by experiment ID
+            session.flush()
+            writer = store.writer(expt_entry.id)
+            store_array = writer.add
+
+        try:
+            self._load_sweeps(nwb, expt_entry, elecs_by_ad_channel, pairs_by_device_id, new_entry, store_array)
+        except:
+            if writer is not None:
+                # don't leave partially written trace data in the store
+                writer.abort()
+            raise
+
+        if writer is not None:
+            # make sure trace data is on disk before the DB transaction is committed
+            writer.close()
+
+        if self.bulk:
+            inserter.flush()
+
+    def _load_sweeps(self, nwb, expt_entry, elecs_by_ad_channel, pairs_by_device_id, new_entry, store_array):
+        # release each sweep's data after it is processed; otherwise loaded data stays
+        # cached on the sweeps in nwb.contents
+        sweeps = prefetch(nwb.contents, lambda srec: srec.load_data(), depth=self.prefetch, threads=self.prefetch_threads,
+                          release=lambda srec: srec.release_data())
+        for srec in sweeps:
             temp = srec.meta.get('temperature', None)
-            srec_entry = db.SyncRec(ext_id=srec.key, experiment=expt_entry, temperature=temp)
-            session.add(srec_entry)
+            srec_entry = new_entry(db.SyncRec, ext_id=srec.key, experiment=expt_entry, temperature=temp)
             
             srec_has_mp_probes = False
             
@@ -288,19 +350,18 @@ class ExperimentDBSubmission(object):
             for rec in srec.recordings:
                 
                 # import all recordings
-                rec_entry = db.Recording(
+                rec_entry = new_entry(db.Recording,
                     sync_rec=srec_entry,
                     electrode=elecs_by_ad_channel[rec.device_id],  # should probably just skip if this causes KeyError?
                     start_time=rec.start_time,
                 )
-                session.add(rec_entry)
                 rec_entries[rec.device_id] = rec_entry
                 
                 # import patch clamp recording information
                 if not isinstance(rec, PatchClampRecording):
                     continue
-                qc_pass = qc.recording_qc_pass(rec)
-                pcrec_entry = db.PatchClampRecording(
+                qc_pass = qc.RecordingQCAnalyzer.get(rec).recording_qc_pass()
+                pcrec_entry = new_entry(db.PatchClampRecording,
                     recording=rec_entry,
                     clamp_mode=rec.clamp_mode,
                     patch_mode=rec.patch_mode,
@@ -310,12 +371,11 @@ class ExperimentDBSubmission(object):
                     baseline_rms_noise=rec.baseline_rms_noise,
                     qc_pass=qc_pass,
                 )
-                session.add(pcrec_entry)
 
                 # import test pulse information
                 tp = rec.nearest_test_pulse
                 if tp is not None:
-                    tp_entry = db.TestPulse(
+                    tp_entry = new_entry(db.TestPulse,
                         start_index=tp.indices[0],
                         stop_index=tp.indices[1],
                         baseline_current=tp.baseline_current,
@@ -325,7 +385,6 @@ class ExperimentDBSubmission(object):
                         capacitance=tp.capacitance,
                         time_constant=tp.time_constant,
                     )
-                    session.add(tp_entry)
                     pcrec_entry.nearest_test_pulse = tp_entry
                     
                 # import information about STP protocol
@@ -334,12 +393,11 @@ class ExperimentDBSubmission(object):
                 srec_has_mp_probes = True
                 psa = PulseStimAnalyzer.get(rec)
                 ind_freq, rec_delay = psa.stim_params()
-                mprec_entry = db.MultiPatchProbe(
+                mprec_entry = new_entry(db.MultiPatchProbe,
                     patch_clamp_recording=pcrec_entry,
                     induction_frequency=ind_freq,
                     recovery_delay=rec_delay,
                 )
-                session.add(mprec_entry)
             
                 # import presynaptic stim pulses
                 pulses = psa.pulses()
@@ -348,6 +406,9 @@ class ExperimentDBSubmission(object):
                 all_pulse_entries[rec.device_id] = pulse_entries
                 
                 rec_tvals = rec['primary'].time_values
+                # all snippets are taken from a single resampled copy of the recording
+                resampler = ResampleAnalyzer.get(rec)
+                rec_dt = rec['primary'].dt
 
                 for i,pulse in enumerate(pulses):
                     # Record information about all pulses, including test pulse.
@@ -355,16 +416,18 @@ class ExperimentDBSubmission(object):
                     t1 = rec_tvals[pulse[1]]
                     data_start = max(0, t0 - 10e-3)
                     data_stop = t0 + 10e-3
-                    pulse_entry = db.StimPulse(
+                    # same indices as time_slice(data_start, data_stop)
+                    i_start = max(0, int(np.round((data_start - rec_tvals[0]) / rec_dt)))
+                    i_stop = max(0, int(np.round((data_stop - rec_tvals[0]) / rec_dt)))
+                    pulse_entry = new_entry(db.StimPulse,
                         recording=rec_entry,
                         pulse_number=i,
                         onset_time=t0,
                         amplitude=pulse[2],
                         duration=t1-t0,
-                        data=rec['primary'].time_slice(data_start, data_stop).resample(sample_rate=20000).data,
+                        data=store_array(resampler.snippet(i_start, i_stop, sample_rate=db.default_sample_rate)),
                         data_start_time=data_start,
                     )
-                    session.add(pulse_entry)
                     pulse_entries[i] = pulse_entry
                     
 
@@ -391,51 +454,46 @@ class ExperimentDBSubmission(object):
                         extra = {}
                         pulse.n_spikes = 0
                     
-                    spike_entry = db.StimSpike(
+                    spike_entry = new_entry(db.StimSpike,
                         pulse=pulse,
                         **extra
                     )
-                    session.add(spike_entry)
                     pulse.first_spike = spike_entry
             
             if not srec_has_mp_probes:
                 continue
             
             # import postsynaptic responses
+            # (responses to all pulses are extracted from every postsynaptic recording at once)
             mpa = MultiPatchSyncRecAnalyzer(srec)
-            for pre_dev in srec.devices:
-                for post_dev in srec.devices:
-                    if pre_dev == post_dev:
-                        continue
-
-                    # get all responses, regardless of the presence of a spike
-                    responses = mpa.get_spike_responses(srec[pre_dev], srec[post_dev], align_to='pulse', require_spike=False)
-                    post_tvals = srec[post_dev]['primary'].time_values
-                    for resp in responses:
-                        # base_entry = db.Baseline(
-                        #     recording=rec_entries[post_dev],
-                        #     start_index=resp['baseline_start'],
-                        #     stop_index=resp['baseline_stop'],
-                        #     data=resp['baseline'].resample(sample_rate=20000).data,
-                        #     mode=float_mode(resp['baseline'].data),
-                        # )
-                        # session.add(base_entry)
-                        pair_entry = pairs_by_device_id[(pre_dev, post_dev)]
-                        if resp['ex_qc_pass']:
+            # get all responses, regardless of the presence of a spike
+            blocks = mpa.get_response_blocks(align_to='pulse', require_spike=False)
+            for pre_dev, block in blocks.items():
+                for j, post_rec in enumerate(block.post_recs):
+                    post_dev = post_rec.device_id
+                    post_trace = post_rec['primary']
+                    post_tvals = post_trace.time_values
+                    pair_entry = pairs_by_device_id[(pre_dev, post_dev)]
+                    for i, pulse in enumerate(block.pulses):
+                        ex_qc_pass = bool(block.ex_qc_pass[j, i])
+                        in_qc_pass = bool(block.in_qc_pass[j, i])
+                        if ex_qc_pass:
                             pair_entry.n_ex_test_spikes += 1
-                        if resp['in_qc_pass']:
+                        if in_qc_pass:
                             pair_entry.n_in_test_spikes += 1
-                        resp_entry = db.PulseResponse(
+                        if post_trace.sample_rate == db.default_sample_rate:
+                            data = block.response(j, i)
+                        else:
+                            data = ResampleAnalyzer.get(post_rec).snippet(pulse['rec_start'], pulse['rec_stop'], sample_rate=db.default_sample_rate)
+                        resp_entry = new_entry(db.PulseResponse,
                             recording=rec_entries[post_dev],
-                            stim_pulse=all_pulse_entries[pre_dev][resp['pulse_n']],
+                            stim_pulse=all_pulse_entries[pre_dev][pulse['pulse_n']],
                             pair=pair_entry,
-                            # baseline=base_entry,
-                            start_time=post_tvals[resp['rec_start']],
-                            data=resp['response'].resample(sample_rate=20000).data,
-                            ex_qc_pass=resp['ex_qc_pass'],
-                            in_qc_pass=resp['in_qc_pass'],
+                            start_time=post_tvals[pulse['rec_start']],
+                            data=store_array(data),
+                            ex_qc_pass=ex_qc_pass,
+                            in_qc_pass=in_qc_pass,
                         )
-                        session.add(resp_entry)
                         
             # generate up to 20 baseline snippets for each recording
             for dev in srec.devices:
@@ -448,20 +506,18 @@ class ExperimentDBSubmission(object):
                         # all out!
                         break
                     start, stop = base
-                    data = rec['primary'][start:stop].resample(sample_rate=20000).data
+                    data = ResampleAnalyzer.get(rec).snippet(start, stop, sample_rate=db.default_sample_rate)
 
                     ex_qc_pass, in_qc_pass = qc.pulse_response_qc_pass(rec, [start, stop], None, [])
 
-                    base_entry = db.Baseline(
+                    base_entry = new_entry(db.Baseline,
                         recording=rec_entries[dev],
                         start_time=rec_tvals[start],
-                        data=data,
+                        data=store_array(data),
                         mode=float_mode(data),
                         ex_qc_pass=ex_qc_pass,
                         in_qc_pass=in_qc_pass,
                     )
-                    session.add(base_entry)
-            
         
     def submit(self):
         session = db.Session()
@@ -0,0 +1,143 @@
+"""
+External storage for trace arrays referenced from the synphys DB.
+
+Keeping millions of short trace snippets inline in the DB makes the tables very
+large. When config.trace_store_path is set, trace data for each experiment is
+instead appended to a single file (expt_<id>.dat) in that directory, and the DB
+stores only a small blob giving the location of each array in the file (see
+array_codec.encode_external). Arrays read back from the store are zero-copy,
+read-only views of a memory map of the file.
+"""
+import os, mmap, threading
+import numpy as np
+
+from .. import config
+from .array_codec import encode_external
+
+
+class ExternalArray(object):
+    """Placeholder for an array that has already been written to the trace store.
+
+    Assigning an ExternalArray to an NDArray column stores only the reference blob.
+    """
+    __slots__ = ['blob']
+
+    def __init__(self, blob):
+        self.blob = blob
+
+
+class TraceStore(object):
+    """Directory of append-only files containing trace data.
+    """
+    # payloads are aligned to this many bytes within each file
+    alignment = 16
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def expt_file(self, expt_id):
+        """Return the name (relative to the store path) of the file used for an experiment.
+        """
+        return 'expt_%d.dat' % expt_id
+
+    def writer(self, expt_id, storage=None):
+        """Return a TraceStoreWriter that appends to the file for the given experiment ID.
+        """
+        return TraceStoreWriter(self, self.expt_file(expt_id), storage=storage or config.array_storage)
+
+    def read(self, rel_path, offset, size):
+        """Return a read-only buffer containing *size* bytes at *offset* in the given file.
+        """
+        with self._lock:
+            mm = self._maps.get(rel_path)
+            if mm is None or offset + size > len(mm):
+                # file is not mapped yet, or has grown since it was mapped
+                with open(os.path.join(self.path, rel_path), 'rb') as fh:
+                    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[rel_path] = mm
+        if offset + size > len(mm):
+            raise IOError("Trace store file %s is too short (%d bytes requested at %d)" % (rel_path, size, offset))
+        # (np.frombuffer rather than memoryview, which does not accept mmap objects on python 2)
+        return np.frombuffer(mm, dtype=np.uint8, count=size, offset=offset)
+
+    def remove(self, expt_id):
+        """Delete the file for the given experiment ID (for example, after the
+        experiment has been deleted from the DB).
+        """
+        rel_path = self.expt_file(expt_id)
+        with self._lock:
+            self._maps.pop(rel_path, None)
+        path = os.path.join(self.path, rel_path)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+class TraceStoreWriter(object):
+    """Appends arrays to a single trace store file.
+
+    Call close() (or use as a context manager) to ensure data is written to disk
+    before the transaction that references it is committed.
+    """
+    def __init__(self, store, rel_path, storage):
+        self.store = store
+        self.rel_path = rel_path
+        self.storage = storage
+        if not os.path.isdir(store.path):
+            os.makedirs(store.path)
+        self.fh = open(os.path.join(store.path, rel_path), 'ab')
+        self.fh.seek(0, os.SEEK_END)
+        self.offset = self.fh.tell()
+        self.start_offset = self.offset
+
+    def add(self, arr):
+        """Append *arr* to the file and return an ExternalArray referencing it.
+        """
+        if arr is None:
+            return None
+        return ExternalArray(encode_external(arr, self._write, storage=self.storage))
+
+    def _write(self, data):
+        pad = -self.offset % self.store.alignment
+        if pad > 0:
+            self.fh.write(b'\0' * pad)
+            self.offset += pad
+        offset = self.offset
+        self.fh.write(data)
+        self.offset += len(data)
+        return self.rel_path, offset
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+
+    def abort(self):
+        """Discard everything written by this writer and close the file.
+        """
+        if self.fh.closed:
+            return
+        self.fh.truncate(self.start_offset)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+_store = None
+def get_trace_store():
+    """Return the TraceStore at config.trace_store_path, or None if no store is configured.
+    """
+    global _store
+    if _store is None and config.trace_store_path is not None:
+        _store = TraceStore(config.trace_store_path)
+    return _store
@@ -0,0 +1,240 @@
+"""
+Persistent, content-addressed cache for fit results.
+
+Fitting the same average response with the same parameters always gives the same
+result, but analyses (rebuilding connectivity tables, re-running analysis scripts)
+repeat these fits many times. When config.fit_cache_path is set, results are
+pickled to files in that directory, named by a hash of everything the fit depends
+on (see make_key). Least recently used entries are deleted when the total size of
+the cache exceeds config.fit_cache_max_size bytes.
+
+    cache = get_fit_cache()
+    key = make_key('fit_psp', 1, response.data, response.dt, params)
+    fit = cache.get(key)
+    if fit is None:
+        fit = do_fit(...)
+        cache.set(key, fit)
+    print(cache.stats())
+"""
+from __future__ import division
+import os, hashlib, pickle, threading
+import numpy as np
+
+from . import config
+
+
+def make_key(*parts):
+    """Return a hex digest identifying *parts*.
+
+    Parts may be (nested) dicts, lists, tuples, numpy arrays, strings, or numbers.
+    Dicts are hashed independently of key order; numeric values are hashed by
+    value (so 1 and 1.0 give the same key); arrays are hashed by dtype, shape,
+    and content.
+    """
+    hash = hashlib.sha1()
+    _update(hash, parts)
+    return hash.hexdigest()
+
+
+def _update(hash, obj):
+    if isinstance(obj, dict):
+        hash.update(b'{')
+        for k in sorted(obj.keys(), key=repr):
+            _update(hash, k)
+            _update(hash, obj[k])
+        hash.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        hash.update(b'(')
+        for item in obj:
+            _update(hash, item)
+        hash.update(b')')
+    elif isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        hash.update(('array:%s:%r:' % (arr.dtype.str, arr.shape)).encode('utf8'))
+        hash.update(arr.view(np.uint8).tobytes() if arr.size > 0 else b'')
+    elif isinstance(obj, (bool, np.bool_)) or obj is None:
+        hash.update(repr(obj).encode('utf8'))
+    elif isinstance(obj, (int, float, np.integer, np.floating)):
+        hash.update(('num:%r' % float(obj)).encode('utf8'))
+    else:
+        hash.update(repr(obj).encode('utf8'))
+    hash.update(b';')
+
+
+class FitCache(object):
+    """Directory of pickled results keyed by make_key() digests.
+
+    Hit, miss, write, and eviction counts for this process are available as
+    attributes and from stats().
+    """
+    def __init__(self, path, max_size=1e9):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.pkl')
+
+    def get(self, key, default=None):
+        """Return the result stored for *key*, or *default* if there is none.
+        """
+        filename = self._file(key)
+        try:
+            fh = open(filename, 'rb')
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return default
+        try:
+            with fh:
+                result = pickle.load(fh)
+        except Exception:
+            # truncated or unreadable entry (for example, pickled with a class that
+            # has since been moved or changed); treat as a miss and remove it
+            try:
+                size = os.path.getsize(filename)
+                os.remove(filename)
+            except OSError:
+                size = 0
+            with self._lock:
+                self.misses += 1
+                if self._size is not None:
+                    self._size -= size
+            return default
+        try:
+            # mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def set(self, key, result):
+        """Store *result* for *key*, evicting old entries if the cache is over its size limit.
+        """
+        filename = self._file(key)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by another process
+                pass
+        tmp_file = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump(result, fh, protocol=2)
+        size = os.path.getsize(tmp_file)
+        try:
+            old_size = os.path.getsize(filename)
+        except OSError:
+            old_size = 0
+        try:
+            # atomically replaces any existing entry (on POSIX)
+            os.rename(tmp_file, filename)
+        except OSError:
+            # rename does not replace existing files on Windows; if another process
+            # wrote the same key in the meantime, keep its result
+            try:
+                os.remove(filename)
+                os.rename(tmp_file, filename)
+            except OSError:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                return
+
+        with self._lock:
+            self.writes += 1
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += size - old_size
+            over = self._size > self.max_size
+        if over:
+            self.evict()
+
+    def size(self):
+        """Return the total size in bytes of all cached results.
+        """
+        return sum([size for _, size, _ in self._entries()])
+
+    def evict(self, target=0.8):
+        """Delete least recently used entries until the cache is smaller than
+        *target* times max_size.
+        """
+        entries = sorted(self._entries())
+        total = sum([size for _, size, _ in entries])
+        limit = self.max_size * target
+        removed = 0
+        for mtime, size, filename in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                # removed by another process
+                pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self._size = total
+            self.evictions += removed
+
+    def clear(self):
+        """Delete all cached results.
+        """
+        for _, _, filename in self._entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+    def _entries(self):
+        # list (mtime, size, filename) for all cached results
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for subdir in os.listdir(self.path):
+            dirname = os.path.join(self.path, subdir)
+            if not os.path.isdir(dirname):
+                continue
+            for name in os.listdir(dirname):
+                if not name.endswith('.pkl'):
+                    continue
+                filename = os.path.join(dirname, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def stats(self):
+        """Return a dict of hit, miss, write, and eviction counts for this process.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else None,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+
+_cache = None
+def get_fit_cache():
+    """Return the FitCache at config.fit_cache_path, or None if no cache is configured.
+    """
+    global _cache
+    if _cache is None and config.fit_cache_path is not None:
+        _cache = FitCache(config.fit_cache_path, max_size=config.fit_cache_max_size)
+    return _cache
@@ -4,6 +4,8 @@ QC functions meant to ensure consistent filtering across different analyses
 """
 import numpy as np
 
+from .data import Analyzer
+
 
 def recording_qc_pass(rec):
     """Applies a minimal set of QC criteria to a recording:
@@ -21,6 +23,8 @@ def recording_qc_pass(rec):
     ----------
     rec : PatchClampRecording
         The PatchClampRecording instance to evaluate
+
+    See also RecordingQCAnalyzer, which caches this result on the recording.
     """
     if rec.baseline_current < -800e-12 or rec.baseline_current > 800e-12:
         return False
@@ -40,6 +44,59 @@ def recording_qc_pass(rec):
     return True
 
 
+class RecordingQCAnalyzer(Analyzer):
+    """Caches QC measurements for a single recording, so that QC for many pulse
+    responses from the same recording only scans the full trace once.
+    """
+    def __init__(self, rec):
+        self._attach(rec)
+        self.rec = rec
+        self._qc_pass = None
+        self._window_stats = {}
+
+    def recording_qc_pass(self):
+        """Return the (cached) result of recording_qc_pass() for this recording.
+        """
+        if self._qc_pass is None:
+            self._qc_pass = recording_qc_pass(self.rec)
+        return self._qc_pass
+
+    def window_stats(self, windows):
+        """Return a list of dicts giving statistics of the recording within each
+        [start, stop] index window.
+
+        Each dict contains the median, std, and max of the primary channel and the
+        median of the command channel. Statistics for all windows not already cached
+        are computed together in one pass.
+        """
+        windows = [(int(w[0]), int(w[1])) for w in windows]
+        new = sorted(set([w for w in windows if w not in self._window_stats]))
+        if len(new) > 0:
+            primary = self.rec['primary'].data
+            pri = _window_array(primary, new)
+            stats = {
+                'median': np.nanmedian(pri, axis=1),
+                'std': np.nanstd(pri, axis=1),
+                'max': np.nanmax(pri, axis=1),
+            }
+            if self.rec.clamp_mode == 'vc':
+                stats['command_median'] = np.nanmedian(_window_array(self.rec['command'].data, new), axis=1)
+            for i, w in enumerate(new):
+                self._window_stats[w] = {k: v[i] for k, v in stats.items()}
+        return [self._window_stats[w] for w in windows]
+
+
+def _window_array(data, windows):
+    """Return a 2D array whose rows hold data[start:stop] for each window, padded with NaN.
+    """
+    lengths = [len(data[start:stop]) for start, stop in windows]
+    arr = np.empty((len(windows), max(max(lengths), 1)))
+    arr[:] = np.nan
+    for i, (start, stop) in enumerate(windows):
+        arr[i, :lengths[i]] = data[start:stop]
+    return arr
+
+
 def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     """Apply QC criteria for pulse-response recordings:
 
@@ -72,29 +129,49 @@ def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     in_qc_pass : bool
         Whether this pulse-response passes QC for detecting inhibitory connections
     """
+    return pulse_response_qc_pass_batch(post_rec, [window], [n_spikes], [adjacent_pulses])[0]
+
+
+def pulse_response_qc_pass_batch(post_rec, windows, n_spikes, adjacent_pulses):
+    """Apply pulse_response_qc_pass() to many pulse responses from the same postsynaptic recording.
+
+    *windows*, *n_spikes*, and *adjacent_pulses* are lists with one item per pulse response.
+    Recording-level QC and window statistics are computed once for all windows (and
+    cached on the recording; see RecordingQCAnalyzer).
+
+    Returns a list of (ex_qc_pass, in_qc_pass) tuples.
+    """
     # Require the postsynaptic recording to pass basic QC
-    if recording_qc_pass(post_rec) is False:
-        return False, False
+    analyzer = RecordingQCAnalyzer.get(post_rec)
+    if analyzer.recording_qc_pass() is False:
+        return [(False, False)] * len(windows)
 
+    stats = analyzer.window_stats(windows)
+    base2 = post_rec.baseline_potential
+    results = []
+    for i in range(len(windows)):
+        results.append(_pulse_response_qc(post_rec.clamp_mode, stats[i], n_spikes[i], adjacent_pulses[i], base2))
+    return results
+
+
+def _pulse_response_qc(clamp_mode, stats, n_spikes, adjacent_pulses, base2):
     # require at least 1 presynaptic spike
     if n_spikes == 0:
         return False, False
     
     # Check for noise in response window
-    if post_rec.clamp_mode == 'ic':
-        data = post_rec['primary'][window[0]:window[1]]
-        base = data.median()
-        if data.std() > 1.5e-3:
+    if clamp_mode == 'ic':
+        base = stats['median']
+        if stats['std'] > 1.5e-3:
             return False, False
-        if data.data.max() > -40e-3:
+        if stats['max'] > -40e-3:
             return False, False
-    elif post_rec.clamp_mode == 'vc':
-        data = post_rec['primary'][window[0]:window[1]]
-        base = post_rec['command'][window[0]:window[1]].median()
-        if data.std() > 15e-12:
+    elif clamp_mode == 'vc':
+        base = stats['command_median']
+        if stats['std'] > 15e-12:
             return False, False
     else:
-        raise TypeError('Unsupported clamp mode %s' % post_rec.clamp_mode)
+        raise TypeError('Unsupported clamp mode %s' % clamp_mode)
 
     # Check timing of adjacent spikes
     if any([abs(t) < 8e-3 for t in adjacent_pulses]):
@@ -104,7 +181,6 @@ def pulse_response_qc_pass(post_rec, window, n_spikes, adjacent_pulses):
     limits = [[-85e-3, -45e-3], [-60e-3, -45e-3]]
     # check both baseline_potential (which is measured over all baseline regions in the recording)
     # and *base*, which is just the median value over the response window
-    base2 = post_rec.baseline_potential
     qc_pass = tuple([((bmin < base < bmax) and (bmin < base2 < bmax)) for bmin, bmax in limits])
 
     return qc_pass
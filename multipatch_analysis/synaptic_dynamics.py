@@ -2,7 +2,7 @@ import sys
 from collections import OrderedDict
 import numpy as np
 import pyqtgraph as pg
-from .connection_detection import MultiPatchSyncRecAnalyzer, EvokedResponseGroup, fit_psp
+from .connection_detection import MultiPatchSyncRecAnalyzer, EvokedResponseGroup, EvokedResponseArray, fit_psp
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.baseline import float_mode
 from neuroanalysis.ui.plot_grid import PlotGrid
@@ -137,9 +137,11 @@ class RawDynamicsAnalyzer(object):
         kinetic parameters.
         """
         pulse_responses = self.pulse_responses
-        kinetics_group = EvokedResponseGroup()
+        # kinetics and all-event groups are only averaged, so raw traces are not kept;
+        # amp_group keeps its response list (used for per-response analyses)
+        kinetics_group = EvokedResponseArray(keep_traces=False)
         amp_group = EvokedResponseGroup()
-        all_group = EvokedResponseGroup()
+        all_group = EvokedResponseArray(keep_traces=False)
         for i,stim_params in enumerate(pulse_responses.keys()):
             # collect all individual pulse responses:
             #  - we can try fitting individual responses averaged across trials
@@ -1,5 +1,9 @@
 from __future__ import print_function
-import os, sys, time
+import os, sys, time, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 def sync_dir(source_path, dest_path, test=False):
@@ -114,3 +118,68 @@ def chunk_copy(src, dst, chunk_size=100e6):
         if os.path.isfile(dst):
             os.remove(dst)
         raise
+
+
+def prefetch(items, load, depth=4, threads=1, release=None):
+    """Iterate over *items* while calling ``load(item)`` on upcoming items in
+    background threads.
+
+    Items are yielded in their original order, each after ``load(item)`` has
+    returned. At most *depth* loaded items wait to be consumed (plus one item
+    being loaded per thread), so the memory used for prefetching stays bounded.
+    Exceptions raised by *load* are re-raised when the failed item is reached.
+    If *depth* is 0, items are yielded without loading.
+
+    If *release* is given, ``release(item)`` is called when the consumer asks for
+    the next item (or stops iterating), so that loaded data does not accumulate
+    in items that are kept alive elsewhere.
+    """
+    items = list(items)
+    if depth < 1:
+        for item in items:
+            try:
+                yield item
+            finally:
+                if release is not None:
+                    release(item)
+        return
+
+    threads = max(1, min(threads, depth, len(items)))
+    # thread i loads items i, i+threads, i+2*threads, ... into queues[i]
+    queues = [queue.Queue(maxsize=max(1, depth // threads)) for i in range(threads)]
+    stop = threading.Event()
+
+    def reader(i):
+        for item in items[i::threads]:
+            try:
+                load(item)
+                msg = (item, None)
+            except Exception as exc:
+                msg = (item, exc)
+            while not stop.is_set():
+                try:
+                    queues[i].put(msg, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or msg[1] is not None:
+                return
+
+    for i in range(threads):
+        thread = threading.Thread(target=reader, args=(i,))
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for j in range(len(items)):
+            item, exc = queues[j % threads].get()
+            if exc is not None:
+                raise exc
+            try:
+                yield item
+            finally:
+                if release is not None:
+                    release(item)
+    finally:
+        # release reader threads if the consumer stops early
+        stop.set()
@@ -0,0 +1,293 @@
+"""
+Process pool for long-running, independent tasks (importing experiments,
+rebuilding analysis tables).
+
+Compared to multiprocessing.Pool(maxtasksperchild=1), a WorkQueue:
+
+* keeps worker processes alive between tasks, and only replaces a worker when
+  its resident memory grows beyond a limit (or it dies)
+* hands out tasks one at a time in the order given, so callers can put the
+  longest tasks first and avoid a slow task stalling the end of the run
+* retries failed tasks with exponential backoff
+* records the status, attempts, timing, and errors of every task, optionally
+  writing them to a JSON summary file
+
+Example::
+
+    queue = WorkQueue(submit_expt, workers=6, max_memory=4e9, retries=2)
+    records = queue.run(expt_ids, summary_file='import_summary.json')
+"""
+from __future__ import print_function, division
+import os, sys, time, json, heapq, pickle, traceback
+import multiprocessing
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def memory_usage():
+    """Return the resident memory size of the current process in bytes, or None
+    if it can't be determined.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak rather than current memory, but good enough to decide on recycling
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _worker_loop(worker_id, fn, tasks, results, max_memory, pass_attempt):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, attempt = task
+        start = time.time()
+        try:
+            if pass_attempt:
+                result = fn(task_id, attempt=attempt)
+            else:
+                result = fn(task_id)
+            ok = True
+        except Exception:
+            result = traceback.format_exc()
+            ok = False
+        duration = time.time() - start
+
+        try:
+            pickle.dumps(result)
+        except Exception:
+            result = repr(result)
+
+        rss = memory_usage()
+        recycle = max_memory is not None and rss is not None and rss > max_memory
+        results.put((worker_id, task_id, ok, result, duration, rss, recycle))
+        if recycle:
+            break
+
+
+class _Worker(object):
+    def __init__(self, worker_id, fn, results, max_memory, pass_attempt):
+        self.id = worker_id
+        self.tasks = multiprocessing.Queue()
+        self.task = None
+        self.retiring = False
+        self.proc = multiprocessing.Process(target=_worker_loop, args=(worker_id, fn, self.tasks, results, max_memory, pass_attempt))
+        self.proc.daemon = True
+        self.proc.start()
+
+
+class WorkQueue(object):
+    """Runs ``fn(task_id)`` for many task IDs in a set of long-lived worker processes.
+
+    Parameters
+    ----------
+    fn : callable
+        Function to run for each task. Task IDs and return values must be picklable;
+        return values should also be JSON-serializable if a summary file is written.
+        The task is considered failed if *fn* raises an exception.
+    workers : int
+        Number of worker processes.
+    max_memory : float | None
+        Workers whose resident memory exceeds this many bytes after finishing a
+        task are replaced with a fresh process.
+    retries : int
+        Number of times a failed task is retried.
+    retry_delay : float
+        Delay in seconds before the first retry; doubled for each subsequent retry.
+    poll_interval : float
+        Interval in seconds at which worker processes are checked.
+    pass_attempt : bool
+        If True, *fn* is called as ``fn(task_id, attempt=n)``, where n is 1 for
+        the first attempt at a task and is incremented for each retry.
+
+    Worker processes are forked from the calling process; DB engines should
+    be disposed before calling run() (see sqlalchemy docs on multiprocessing).
+    """
+    def __init__(self, fn, workers=4, max_memory=None, retries=2, retry_delay=10.0, poll_interval=1.0, pass_attempt=False):
+        self.fn = fn
+        self.pass_attempt = pass_attempt
+        self.n_workers = workers
+        self.max_memory = max_memory
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+    def run(self, task_ids, summary_file=None):
+        """Run all tasks, in order of priority given by *task_ids*.
+
+        Return a list of task records (dicts with keys id, status, attempts,
+        duration, durations, max_rss, errors, result, worker_pids). Status is
+        'ok' or 'failed'.
+        """
+        self.records = OrderedDict()
+        for tid in task_ids:
+            self.records[tid] = {
+                'id': tid, 'status': 'pending', 'attempts': 0, 'duration': 0.0, 'durations': [],
+                'max_rss': None, 'errors': [], 'result': None, 'worker_pids': [],
+            }
+        self._order = {tid: i for i, tid in enumerate(self.records)}
+        self._pending = [(i, tid) for tid, i in self._order.items()]
+        heapq.heapify(self._pending)
+        self._delayed = []
+        self._results = multiprocessing.Queue()
+        self._workers = OrderedDict()
+        self._next_worker_id = 0
+        self._n_done = 0
+        self.start_time = time.time()
+        self.summary_file = summary_file
+
+        try:
+            while len(self._pending) > 0 or len(self._delayed) > 0 or self._n_busy() > 0:
+                self._release_delayed()
+                self._reap_workers()
+                self._start_workers()
+                self._assign_tasks()
+                try:
+                    msg = self._results.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+                self._handle_result(msg)
+        finally:
+            self._stop_workers()
+            self.write_summary()
+
+        return list(self.records.values())
+
+    def _n_busy(self):
+        return len([w for w in self._workers.values() if w.task is not None])
+
+    def _release_delayed(self):
+        now = time.time()
+        ready = [d for d in self._delayed if d[0] <= now]
+        for item in ready:
+            self._delayed.remove(item)
+            heapq.heappush(self._pending, item[1:])
+
+    def _reap_workers(self):
+        for wid, worker in list(self._workers.items()):
+            if worker.proc.is_alive():
+                continue
+            worker.proc.join()
+            if worker.task is not None:
+                # collect any result the worker sent before exiting
+                self._drain_results()
+            if worker.task is not None:
+                self._task_failed(worker.task, "Worker process %d exited with code %s" % (worker.proc.pid, worker.proc.exitcode))
+                worker.task = None
+            del self._workers[wid]
+
+    def _drain_results(self):
+        while True:
+            try:
+                msg = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._handle_result(msg)
+
+    def _start_workers(self):
+        idle = len([w for w in self._workers.values() if w.task is None and not w.retiring])
+        n_active = len([w for w in self._workers.values() if not w.retiring])
+        while n_active < self.n_workers and idle < len(self._pending):
+            worker = _Worker(self._next_worker_id, self.fn, self._results, self.max_memory, self.pass_attempt)
+            self._workers[worker.id] = worker
+            self._next_worker_id += 1
+            n_active += 1
+            idle += 1
+
+    def _assign_tasks(self):
+        for worker in self._workers.values():
+            if len(self._pending) == 0:
+                break
+            if worker.task is not None or worker.retiring:
+                continue
+            _, tid = heapq.heappop(self._pending)
+            rec = self.records[tid]
+            rec['status'] = 'running'
+            rec['attempts'] += 1
+            rec['worker_pids'].append(worker.proc.pid)
+            worker.task = tid
+            worker.tasks.put((tid, rec['attempts']))
+
+    def _handle_result(self, msg):
+        worker_id, tid, ok, result, duration, rss, recycle = msg
+        worker = self._workers.get(worker_id)
+        if worker is not None:
+            worker.task = None
+            worker.retiring = recycle
+
+        rec = self.records[tid]
+        rec['durations'].append(duration)
+        rec['duration'] += duration
+        if rss is not None:
+            rec['max_rss'] = rss if rec['max_rss'] is None else max(rec['max_rss'], rss)
+
+        if ok:
+            rec['status'] = 'ok'
+            rec['result'] = result
+            self._task_finished(tid)
+        else:
+            self._task_failed(tid, result)
+
+        if recycle:
+            print("Recycling worker %d (%0.0f MB resident)" % (worker_id, rss * 1e-6))
+
+    def _task_failed(self, tid, error):
+        rec = self.records[tid]
+        rec['errors'].append(error)
+        if rec['attempts'] <= self.retries:
+            delay = self.retry_delay * 2**(rec['attempts'] - 1)
+            rec['status'] = 'retrying'
+            self._delayed.append((time.time() + delay, self._order[tid], tid))
+            print("Task %s failed (attempt %d); retrying in %0.0f s" % (tid, rec['attempts'], delay))
+        else:
+            rec['status'] = 'failed'
+            self._task_finished(tid)
+
+    def _task_finished(self, tid):
+        rec = self.records[tid]
+        self._n_done += 1
+        print("[%d/%d] %s %s  (%0.1f s)" % (self._n_done, len(self.records), tid, rec['status'], rec['duration']))
+        self.write_summary()
+
+    def _stop_workers(self):
+        for worker in self._workers.values():
+            if worker.proc.is_alive():
+                if worker.task is None:
+                    worker.tasks.put(None)
+                else:
+                    worker.proc.terminate()
+        for worker in self._workers.values():
+            worker.proc.join()
+        self._workers.clear()
+
+    def write_summary(self):
+        """Write task records to the summary file as JSON (if a summary file was given).
+        """
+        if self.summary_file is None:
+            return
+        summary = {
+            'start_time': self.start_time,
+            'elapsed': time.time() - self.start_time,
+            'workers': self.n_workers,
+            'counts': {},
+            'tasks': list(self.records.values()),
+        }
+        for rec in self.records.values():
+            summary['counts'][rec['status']] = summary['counts'].get(rec['status'], 0) + 1
+
+        tmp_file = self.summary_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump(summary, fh, indent=2, default=repr)
+        if os.path.exists(self.summary_file):
+            os.remove(self.summary_file)
+        os.rename(tmp_file, self.summary_file)
@@ -1,23 +1,41 @@
 from __future__ import print_function
 
 import os, sys, time, glob, argparse
-import multiprocessing
+from functools import partial
+from collections import OrderedDict
 
 import pyqtgraph as pg
 pg.dbg()
 
 from multipatch_analysis.database.submission import SliceSubmission, ExperimentDBSubmission
-from multipatch_analysis.database import database
+from multipatch_analysis.database import database, import_ledger
 from multipatch_analysis import config, synphys_cache, experiment_list, constants
+from multipatch_analysis.work_queue import WorkQueue
 
 
 all_expts = experiment_list.cached_experiments()
 
 
-def submit_expt(expt_id, raise_exc=False):
+def submit_expt(expt_id, raise_exc=False, bulk=False, prefetch=0, incremental=False, retry_failed=False, attempt=1):
+    """Import one experiment.
+
+    *attempt* is the work queue attempt number. Retried experiments failed
+    earlier in this run, so in incremental mode they are imported again even
+    though the ledger marks them as failed.
+
+    Return (expt_id, action, reason) describing the outcome, where action is
+    'imported', 'recorded', 'skipped', or 'failed'.
+    """
     # print(os.getpid(), expt_id, "start")
     try:
         expt = all_expts[expt_id]
+        start = time.time()
+
+        if incremental:
+            print("import experiment:", expt)
+            action, reason = import_ledger.import_experiment(expt, retry_failed=retry_failed or attempt > 1, bulk=bulk, prefetch=prefetch)
+            print("    %s %s: %s  (%g sec)" % (expt_id, action, reason, time.time()-start))
+            return expt_id, action, reason
         
         slice_dir = expt.slice_dir
         print("submit slice:", slice_dir)
@@ -27,26 +45,53 @@ def submit_expt(expt_id, raise_exc=False):
         else:
             sub.submit()
         
-        start = time.time()
-        
         print("submit experiment:")
         print("    ", expt)
-        sub = ExperimentDBSubmission(expt)
+        sub = ExperimentDBSubmission(expt, bulk=bulk, prefetch=prefetch)
         if sub.submitted():
             print("   already in DB")
+            result = (expt_id, 'skipped', 'already in DB')
         else:
             sub.submit()
+            result = (expt_id, 'imported', 'new experiment')
 
         print("    %g sec" % (time.time()-start))
-    except Exception:
-        print(">>>> %d Error importing experiment %s" % (os.getpid(), expt.uid))
+        return result
+    except Exception as exc:
+        print(">>>> %d Error importing experiment %s" % (os.getpid(), expt_id))
         sys.excepthook(*sys.exc_info())
-        print("<<<< %s" % expt.uid)
+        print("<<<< %s" % expt_id)
         if raise_exc:
             raise
+        return expt_id, 'failed', '%s: %s' % (type(exc).__name__, exc)
     # print(os.getpid(), expt_id, "return")
 
 
+def nwb_size(expt):
+    try:
+        return os.stat(expt.nwb_file).st_size
+    except Exception:
+        return 0
+
+
+def print_report(results):
+    """Print a summary of import outcomes, listing every experiment that was not imported.
+    """
+    by_action = OrderedDict()
+    for expt_id, action, reason in results:
+        by_action.setdefault(action, []).append((expt_id, reason))
+
+    print("\n========== Import summary ==========")
+    for action, items in by_action.items():
+        print("%s: %d" % (action, len(items)))
+    for action, items in by_action.items():
+        if action == 'imported':
+            continue
+        print("\n%s:" % action)
+        for expt_id, reason in items:
+            print("    %s  %s" % (expt_id, reason))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--limit', type=int, default=None)
@@ -55,6 +100,14 @@ if __name__ == '__main__':
     parser.add_argument('--uid', type=str, default=None)
     parser.add_argument('--ex-only', action='store_true', default=False, dest='ex_only', help='Only import experiments with excitatory types')
     parser.add_argument('--raise-exc', action='store_true', default=False, dest='raise_exc', help='Do not ignore exceptions')
+    parser.add_argument('--bulk', action='store_true', default=False, help='Write NWB-derived rows with bulk COPY instead of the ORM')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of sweeps to read ahead from the NWB file in background threads while importing')
+    parser.add_argument('--incremental', action='store_true', default=False, help='Use the import ledger to import only new or changed experiments, and to resume interrupted imports')
+    parser.add_argument('--retry-failed', action='store_true', default=False, dest='retry_failed', help='In incremental mode, retry experiments whose last import failed')
+    parser.add_argument('--retries', type=int, default=2, help='Number of times to retry a failed experiment')
+    parser.add_argument('--retry-delay', type=float, default=30., dest='retry_delay', help='Seconds to wait before the first retry (doubled for each retry)')
+    parser.add_argument('--max-worker-mem', type=float, default=4000, dest='max_worker_mem', help='Replace worker processes whose memory use exceeds this many MB')
+    parser.add_argument('--summary', type=str, default='import_summary.json', help='JSON file to write per-experiment status and timing to')
     
     args, extra = parser.parse_known_args(sys.argv[1:])
     
@@ -88,16 +141,35 @@ if __name__ == '__main__':
           (len(all_expts), len(selected_expts)))
     print([ex.uid for ex in selected_expts])
     
+    if args.incremental:
+        import_ledger.create_ledger_table()
+    submit = partial(submit_expt, bulk=args.bulk, prefetch=args.prefetch, incremental=args.incremental, retry_failed=args.retry_failed)
+
     if args.local is True:
+        results = []
         for i, expt in enumerate(selected_expts):
-            submit_expt(expt.uid, raise_exc=args.raise_exc)
+            results.append(submit(expt.uid, raise_exc=args.raise_exc))
     else:
+        # Start with the largest experiments so that they don't end up running
+        # alone at the end of the import
+        selected_expts.sort(key=nwb_size, reverse=True)
         ids = [expt.uid for expt in selected_expts]
 
         # Dispose DB engine before forking, otherwise child processes will
         # inherit and muck with the same connections. See:
         # http://docs.sqlalchemy.org/en/rel_1_0/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
         database.engine.dispose()
-        
-        pool = multiprocessing.Pool(processes=args.workers, maxtasksperchild=1)
-        pool.map(submit_expt, ids, chunksize=1)  # note: maxtasksperchild is broken unless we also force chunksize
+
+        # exceptions must propagate for the work queue to retry failed experiments
+        queue = WorkQueue(partial(submit, raise_exc=True), workers=args.workers, max_memory=args.max_worker_mem*1e6,
+                          retries=args.retries, retry_delay=args.retry_delay, pass_attempt=True)
+        records = queue.run(ids, summary_file=args.summary)
+        results = []
+        for rec in records:
+            if rec['status'] == 'ok':
+                results.append(rec['result'])
+            else:
+                error = rec['errors'][-1].strip().split('\n')[-1]
+                results.append((rec['id'], 'failed', '%s (%d attempts)' % (error, rec['attempts'])))
+
+    print_report(results)
@@ -0,0 +1,143 @@
+"""
+Re-encode the array (trace data) columns of the synphys DB.
+
+This can be used to change the storage precision / compression of arrays stored
+in the DB, or to move trace data between the DB and the external trace store
+(config.trace_store_path):
+
+    python util/migrate_arrays.py --compression=zstd
+    python util/migrate_arrays.py --external
+    python util/migrate_arrays.py --inline
+
+Rows are rewritten in batches ordered by ID; each batch is committed separately
+so the migration may be interrupted and resumed with --start-id.
+"""
+from __future__ import print_function
+import sys, argparse
+
+import sqlalchemy
+from sqlalchemy import LargeBinary
+from multipatch_analysis.database import database as db
+from multipatch_analysis.database.array_codec import encode_array, decode_array, is_external
+from multipatch_analysis.database.trace_store import get_trace_store
+from multipatch_analysis import config
+
+
+array_columns = [
+    ('pulse_response', 'data'),
+    ('baseline', 'data'),
+    ('stim_pulse', 'data'),
+]
+
+
+def migrate_column(table, column, encode, batch_size=1000, start_id=0):
+    """Rewrite all values in *table*.*column*.
+
+    Each value is decoded and passed to *encode(arr, blob, expt_id)*, which returns
+    the new blob to store (or None to leave the row unchanged).
+    """
+    tables = db.ORMBase.metadata.tables
+    tab = tables[table]
+    rec = tables['recording']
+    srec = tables['sync_rec']
+    id_col = tab.c.id
+    # read and write raw bytes rather than letting NDArray decode/encode
+    raw_col = sqlalchemy.type_coerce(tab.c[column], LargeBinary)
+    join = tab.join(rec, tab.c.recording_id == rec.c.id).join(srec, rec.c.sync_rec_id == srec.c.id)
+    update = tab.update().where(id_col == sqlalchemy.bindparam('_id')).values(
+        {column: sqlalchemy.bindparam('_data', type_=LargeBinary)})
+
+    max_id = db.engine.execute(sqlalchemy.select([sqlalchemy.func.max(id_col)])).scalar()
+    size_before = 0
+    size_after = 0
+    next_id = start_id
+    with db.engine.connect() as conn:
+        while True:
+            q = sqlalchemy.select([id_col, raw_col, srec.c.experiment_id]).select_from(join)
+            q = q.where(id_col >= next_id).order_by(id_col).limit(batch_size)
+            rows = conn.execute(q).fetchall()
+            if len(rows) == 0:
+                break
+
+            updates = []
+            for row_id, blob, expt_id in rows:
+                if blob is None or len(blob) == 0:
+                    continue
+                new_blob = encode(decode_array(blob, read_external=db.read_external_array), blob, expt_id)
+                if new_blob is None:
+                    continue
+                size_before += len(blob)
+                size_after += len(new_blob)
+                updates.append({'_id': row_id, '_data': new_blob})
+
+            # any trace store files written must be on disk before committing
+            close_writers()
+            with conn.begin():
+                if len(updates) > 0:
+                    conn.execute(update, updates)
+
+            next_id = rows[-1][0] + 1
+            sys.stdout.write("%s.%s: %d / %d   %0.1f MB => %0.1f MB     \r" % (table, column, next_id, max_id, size_before*1e-6, size_after*1e-6))
+            sys.stdout.flush()
+    print("")
+
+
+_writers = {}
+def trace_store_writer(expt_id):
+    writer = _writers.get(expt_id)
+    if writer is None:
+        writer = get_trace_store().writer(expt_id)
+        _writers[expt_id] = writer
+    return writer
+
+
+def close_writers():
+    for writer in _writers.values():
+        writer.close()
+    _writers.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tables', type=str, default=None, help='Comma-separated list of tables to migrate (default is all trace tables)')
+    parser.add_argument('--storage', type=str, default=config.array_storage, choices=['float64', 'float32', 'int16'])
+    parser.add_argument('--compression', type=str, default=config.array_compression, choices=['none', 'zstd', 'blosc'])
+    parser.add_argument('--level', type=int, default=config.array_compression_level)
+    parser.add_argument('--external', action='store_true', default=False, help='Move array data from the DB into the trace store')
+    parser.add_argument('--inline', action='store_true', default=False, help='Move array data from the trace store back into the DB')
+    parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size')
+    parser.add_argument('--start-id', type=int, default=0, dest='start_id')
+    parser.add_argument('--vacuum', action='store_true', default=False, help='Vacuum tables after migration to reclaim space')
+
+    args, extra = parser.parse_known_args(sys.argv[1:])
+
+    compression = None if args.compression in (None, 'none') else args.compression
+
+    if args.external:
+        if get_trace_store() is None:
+            raise Exception("No trace store configured; set trace_store_path in config.yml")
+        def encode(arr, blob, expt_id):
+            if is_external(blob):
+                return None
+            return trace_store_writer(expt_id).add(arr).blob
+    elif args.inline:
+        def encode(arr, blob, expt_id):
+            if not is_external(blob):
+                return None
+            return encode_array(arr, storage=args.storage, compression=compression, level=args.level)
+    else:
+        def encode(arr, blob, expt_id):
+            if is_external(blob):
+                return None
+            return encode_array(arr, storage=args.storage, compression=compression, level=args.level)
+
+    columns = array_columns
+    if args.tables is not None:
+        tables = args.tables.split(',')
+        columns = [c for c in columns if c[0] in tables]
+
+    for table, column in columns:
+        migrate_column(table, column, encode, batch_size=args.batch_size, start_id=args.start_id)
+
+    if args.vacuum:
+        db.vacuum([c[0] for c in columns])